@@ -1,11 +1,23 @@
 
-from copy import *
-from math import *
+# Modules that take a while to import, like asyncio, concurrent.futures and
+# NumPy, are imported by the functions that need them instead of up here, so
+# that importing this as a library or running a single map starts quickly.
 
+import hashlib
+import heapq
+import os
 import random
+import struct
 import sys
 import time
 
+from collections import OrderedDict, deque, namedtuple
+from math import ceil, floor, sqrt
+from random import Random
+
+# Set by _importNumpy() once a world uses the numpy backend
+numpy = None
+
 #################
 # Configuration #
 #################
@@ -22,12 +34,60 @@ bossTile            = '@'
 chestTile           = '$'
 monsterTile         = '~'
 stairTile           = '/'
+upStairTile         = '\\'
 
+# Benchmark mode. Times every generation phase separately over a sweep of
+# world sizes and room counts, and writes the percentiles to BENCHMARK_FILE
+# so runs from different versions can be compared.
 BENCHMARK           = False
 BENCHMARK_RUNS      = 10
+BENCHMARK_WARMUP    = 3
+BENCHMARK_SIZES     = [(48, 256), (128, 128), (256, 256)]# (width, height)
+BENCHMARK_ROOMS     = [16, 64, 256]
+BENCHMARK_FILE      = "benchmark.json"
 
 PRINT_TO_FILE       = False
 FILE_NAME           = "dungeonTest142.txt"
+# Format of written files: "text", "ascii", "axes", "png" or "binary"
+FILE_FORMAT         = "text"
+
+# Batch mode. Set BATCH_SEEDS to a list or range of seeds to generate all of
+# them across a pool of worker processes instead of a single map. Each map is
+# written to BATCH_FILE_NAME, formatted with its seed. A seed always produces
+# the same file no matter which worker generated it.
+BATCH_SEEDS         = None
+BATCH_FILE_NAME     = "dungeon{seed}.txt"
+BATCH_WORKERS       = None# None uses every core, 0 generates in this process
+BATCH_CHUNK_SIZE    = 16
+BATCH_ORDERED       = True
+
+# Sweep mode. Set SWEEP_SEEDS to a list or range of seeds to generate all of
+# them and write statistics about each map to SWEEP_FILE instead of the maps,
+# as JSON lines, or CSV if the name ends in .csv. Totals over every map so far
+# are written to SWEEP_SUMMARY_FILE every SWEEP_SUMMARY_EVERY maps, or only at
+# the end if that's 0. Workers and chunk sizes come from the batch settings above.
+SWEEP_SEEDS         = None
+SWEEP_FILE          = "sweep.jsonl"
+SWEEP_SUMMARY_FILE  = "sweepSummary.json"
+SWEEP_SUMMARY_EVERY = 10000
+
+# Tower mode. Set TOWER_FLOORS above 1 to generate a stack of floors at once,
+# each one in its own worker process. Every floor's stairs lead down onto the
+# up-stairs of the floor below, on the same tile. Floors are written to
+# TOWER_FILE_NAME, formatted with their floor number.
+TOWER_FLOORS        = 1
+TOWER_FILE_NAME     = "dungeonFloor{floor}.txt"
+TOWER_WORKERS       = None# None uses every core, 0 generates in this process
+
+# Service mode. Set SERVICE to True to serve dungeons to other local processes
+# instead of generating a map, see DungeonService for the protocol. Seeds in
+# SERVICE_PREWARM are generated as binary output as soon as it starts.
+SERVICE             = False
+SERVICE_HOST        = "127.0.0.1"
+SERVICE_PORT        = 8642
+SERVICE_WORKERS     = None# None uses every core, 0 generates on a thread
+SERVICE_CACHE_SIZE  = 256# Outputs kept in memory
+SERVICE_PREWARM     = []
 
 MIN_ROOM_HEIGHT     = 3
 MIN_ROOM_WIDTH      = 3
@@ -42,12 +102,38 @@ WORLD_WIDTH         = 48
 
 ROOM_COUNT          = 16
 
+# How the world grid is stored. "list" is a list of lists of tiles.
+# "numpy" stores tile codes in a 2D uint8 array and writes rooms and
+# corridors as slices, which is much faster on large worlds. Needs NumPy.
+# "geometry" doesn't build a grid at all, and only keeps the rooms, corridors
+# and stairs. Tiles are worked out from those when they're asked for, so huge
+# worlds that are mostly solid rock only cost as much memory as what's in them.
+WORLD_BACKEND       = "list"
+
+# How rooms are placed. "reject" picks random positions and throws away
+# ones that overlap, giving up after 128 tries. "packed" keeps track of the
+# free space and only picks from positions where the room fits, so it keeps
+# placing rooms on crowded maps until there's truly no room left.
+PLACEMENT_STRATEGY  = "reject"
+
+# Which pairs of doors are considered when building the spanning tree.
+# "all" compares every door with every other door, which is fine for small
+# maps but grows quadratically. "knn" only keeps each door's nearest
+# neighbours, widening the search automatically if the result would leave
+# part of the map disconnected.
+PATH_CANDIDATES     = "all"
+PATH_NEIGHBOURS     = 8
+
 MIN_CHEST_COUNT     = 0
 MAX_CHEST_COUNT     = 3
 
 MIN_MONSTER_COUNT   = 1
 MAX_MONSTER_COUNT   = 2
 
+# Most of a room that chests and monsters can cover, from 0 to 1. Monsters are
+# placed first, so when a small room can't fit both, it gets fewer chests.
+DECOR_DENSITY       = 0.5
+
 # These disable the effect the feature has on the world,
 # but doesn't outright disable the feature entirely. Generation
 # will work exactly the same, and the data itself will still be
@@ -63,18 +149,22 @@ PRINT_FINAL_DUNGEON = True
 PRINT_EVERY_ROOM    = False
 PRINT_EVERY_PATH    = False
 
-# Debugs room generation
-DEBUG_ROOM_GEN      = False
-# Debugs room generation. Will print a list of generated
-# rooms, specifically their bounds.
-DEBUG_ROOMS         = False
-# Debugs pathing between rooms. Prints off the finished
-# minimum weight spanning tree, and where paths are generated.
-DEBUG_KRUSKAL       = False
-# Prints when a vertical path is generated
-DEBUG_V_PATHS       = False
-DEBUG_H_PATHS       = False
-DEBUG_D_PATHS       = False
+# Checks that every room can be walked to from the stairs, and prints
+# any rooms or decor that can't be reached.
+VALIDATE_CONNECTIVITY = False
+
+# Prints generation events as they happen. Set to True for every event,
+# or to a list of the ones you want:
+#   "roomAttempt"    every room bounds tried, placed or not
+#   "room"           a room was placed
+#   "rooms"          every placed room and its maximum doors
+#   "mst"            the finished minimum weight spanning tree
+#   "stairs"         where the stairs ended up
+#   "path"           a corridor was dug, and which segments it used
+#   "diagonalRetry"  a diagonal corridor hit a room and was retried
+TRACE_EVENTS        = None
+# Prints the counters and histograms gathered while generating
+PRINT_STATS         = False
 
 ##################
 # Program beyond #
@@ -82,6 +172,11 @@ DEBUG_D_PATHS       = False
 ##################
 
 # IMPORTANT CONSTANTS
+
+# Bump whenever a change makes the same config and seed produce a different
+# dungeon, so cached dungeons from older versions are never handed out.
+GENERATOR_VERSION = 7
+
 LEFT        = 0
 TOP         = 1
 RIGHT       = 2
@@ -93,6 +188,78 @@ BOTTOM      = 3
 def _2da(x, y, v):
     return [[v] * x for b in range(y)]
 
+def _importNumpy():
+    global numpy
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("The numpy world backend needs NumPy installed") from None
+
+# NumPy world backend. Tiles are stored as palette codes and only turned
+# back into characters when the world is printed or written out. Every
+# other numpy code path starts from an ArrayWorld, so creating one is
+# what imports NumPy.
+class ArrayWorld:
+    def __init__(self, width, height, tile):
+        _importNumpy()
+        self.palette = [tile]
+        self.codes = {tile: 0}
+        self.tiles = numpy.zeros((height, width), dtype = numpy.uint8)
+    
+    def code(self, tile):
+        code = self.codes.get(tile)
+        if code is None:
+            if len(self.palette) == 256:
+                raise ValueError("Too many distinct tiles for the numpy world backend")
+            code = len(self.palette)
+            self.palette.append(tile)
+            self.codes[tile] = code
+        return code
+    
+    def rows(self):
+        lookup = numpy.frombuffer(''.join(self.palette).encode('latin-1'), dtype = numpy.uint8)
+        chars = lookup[self.tiles]
+        for y in range(chars.shape[0]):
+            yield chars[y].tobytes().decode('latin-1')
+
+def newWorld(width, height, tile, backend = "list"):
+    if backend == "numpy":
+        return ArrayWorld(width, height, tile)
+    if backend != "list":
+        raise ValueError(f"Unknown world backend: {backend}")
+    return _2da(width, height, tile)
+
+def setTile(world, y, x, tile):
+    if isinstance(world, ArrayWorld):
+        world.tiles[y, x] = world.code(tile)
+    else:
+        world[y][x] = tile
+
+def getTile(world, y, x):
+    if isinstance(world, ArrayWorld):
+        return world.palette[world.tiles[y, x]]
+    return world[y][x]
+
+# Yields every row of the world as a string
+def worldRows(world):
+    if isinstance(world, ArrayWorld):
+        yield from world.rows()
+    else:
+        for row in world:
+            yield ''.join(row)
+
+# Mixes a seed with any number of keys into a new 63-bit seed. Unlike hash(),
+# this is stable between runs and processes.
+def deriveSeed(seed, *keys):
+    digest = hashlib.blake2b(repr((seed,) + keys).encode(), digest_size = 8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+# The random stream for one step of generating a dungeon, like ("room", 3) or
+# ("path", 12). Streams don't share any state, so a step draws the same numbers
+# whether or not the steps before it ran, and in whatever order they ran.
+def phaseRng(seed, phase, index = 0):
+    return Random(deriveSeed(seed, phase, index))
+
 # Finds the center of a boundary
 def center(room):
     return (round(room[LEFT] + ((room[RIGHT] - room[LEFT]) / 2)),
@@ -114,14 +281,20 @@ def distManhatten(a, b):
 # Kruskal's algorithm
 
 def find(parents, room):
-    if parents[room] == room:
-        return room
-    return find(parents, parents[room])
+    root = room
+    while parents[root] != root:
+        root = parents[root]
+    # Path compression, so later lookups on this chain are constant time
+    while parents[room] != root:
+        parents[room], room = root, parents[room]
+    return root
 
 def union(parents, ranks, a, b):
     aroot = find(parents, a)
     broot = find(parents, b)
 
+    if aroot == broot:
+        return
     if ranks[aroot] == ranks[broot]:
         parents[broot] = aroot
         ranks[aroot] += 1
@@ -130,20 +303,148 @@ def union(parents, ranks, a, b):
     elif ranks[aroot] > ranks[broot]:
         parents[broot] = aroot
 
+# Yields edges cheapest first without sorting the whole list up front.
+# Heapifying is linear, and Kruskal usually stops after a short prefix.
+def edgesByWeight(edges):
+    heapq.heapify(edges)
+    while edges:
+        yield heapq.heappop(edges)
+
+# Picks from [start + inset, end - inset), ignoring the inset when it would leave
+# nothing to pick from. Boss room door bounds are only one tile wide.
+def insetRandrange(rng, start, end, inset):
+    if end - start > 2 * inset:
+        return rng.randrange(start + inset, end - inset)
+    return rng.randrange(start, end)
+
+# Candidate edges
+# Edges are (distance, doorIndex, otherDoorIndex) with doorIndex < otherDoorIndex,
+# so sorting them gives the same order regardless of how they were gathered.
+
+def allCandidateEdges(doorRooms, centers):
+    edges = []
+    for bi in range(len(doorRooms)):
+        for bi0 in range(bi + 1, len(doorRooms)):
+            if doorRooms[bi] == doorRooms[bi0]:
+                continue
+            edges.append((distEuclid(centers[bi], centers[bi0]), bi, bi0))
+    return edges
+
+def nearestCandidateEdges(config, doorRooms, centers, k):
+    cellSize = max(config.maxRoomWidth, config.maxRoomHeight) * 2
+    buckets = {}
+    for bi, c in enumerate(centers):
+        buckets.setdefault((c[0] // cellSize, c[1] // cellSize), []).append(bi)
+    
+    maxRing = max(config.worldWidth, config.worldHeight) // cellSize + 1
+    pairs = set()
+    
+    for bi, c in enumerate(centers):
+        roomIndex = doorRooms[bi]
+        cx = c[0] // cellSize
+        cy = c[1] // cellSize
+        best = []# max-heap of (-dist, otherIndex)
+        
+        for ring in range(maxRing + 1):
+            # Anything in this ring or further out is at least this far away
+            if len(best) == k and (ring - 1) * cellSize > -best[0][0]:
+                break
+            for y in range(cy - ring, cy + ring + 1):
+                for x in range(cx - ring, cx + ring + 1):
+                    if max(abs(x - cx), abs(y - cy)) != ring:
+                        continue
+                    for bi0 in buckets.get((x, y), ()):
+                        if doorRooms[bi0] == roomIndex:
+                            continue
+                        d = distEuclid(c, centers[bi0])
+                        if len(best) < k:
+                            heapq.heappush(best, (-d, bi0))
+                        elif d < -best[0][0]:
+                            heapq.heapreplace(best, (-d, bi0))
+        
+        for negDist, bi0 in best:
+            pairs.add((min(bi, bi0), max(bi, bi0)))
+    
+    return [(distEuclid(centers[a], centers[b]), a, b) for a, b in pairs]
+
+# Kruskal's algorithm over the candidate edges, skipping any edge that would
+# give a room more doors than it has. Consumes edges. Returns the tree's edges,
+# the number of doors each room ended up using, how many edges were looked at
+# and how many of those were skipped for doors.
+def doorLimitedTree(edges, doorRooms, maxDoors, roomCount):
+    parents = [i for i in range(roomCount)]
+    ranks = [0] * roomCount
+    tree = []
+    doorCounts = [0] * roomCount
+    
+    edgesConsidered = 0
+    skippedForDoors = 0
+    
+    for edge in edgesByWeight(edges):
+        if len(tree) == roomCount - 1:
+            break
+        edgesConsidered += 1
+        firstRoomIndex = doorRooms[edge[1]]
+        otherRoomIndex = doorRooms[edge[2]]
+        # Could add a condition to check for intersecting rooms, but that would have
+        # limited use, and wouldn't be very practical. Not to mention make the code
+        # run significantly slower.
+        if doorCounts[firstRoomIndex] == maxDoors[firstRoomIndex] or doorCounts[otherRoomIndex] == maxDoors[otherRoomIndex]:
+            skippedForDoors += 1
+            continue
+        # Two single door rooms joined to each other would be cut off from the rest
+        if maxDoors[firstRoomIndex] == 1 and maxDoors[otherRoomIndex] == 1 and roomCount > 2:
+            skippedForDoors += 1
+            continue
+        if find(parents, firstRoomIndex) != find(parents, otherRoomIndex):
+            tree.append(edge)
+            union(parents, ranks, firstRoomIndex, otherRoomIndex)
+            
+            doorCounts[firstRoomIndex] += 1
+            doorCounts[otherRoomIndex] += 1
+    
+    return tree, doorCounts, edgesConsidered, skippedForDoors
+
+def candidateEdges(config, doorRooms, centers, maxDoors):
+    mode = config.pathCandidates
+    k = config.pathNeighbours
+    roomCount = len(maxDoors)
+    
+    if mode == "knn":
+        # Door limits can use up the few edges near a room, so the nearest
+        # edges are only enough if the tree built from them is complete
+        while k < len(doorRooms) - 1:
+            edges = nearestCandidateEdges(config, doorRooms, centers, k)
+            if len(doorLimitedTree(list(edges), doorRooms, maxDoors, roomCount)[0]) == roomCount - 1:
+                return edges
+            k *= 2
+    elif mode != "all":
+        raise ValueError(f"Unknown path candidate mode: {mode}")
+    
+    return allCandidateEdges(doorRooms, centers)
+
 # Fill functions
 
 def fill(world, tile, bounds):
+    if isinstance(world, ArrayWorld):
+        world.tiles[bounds[TOP]:bounds[BOTTOM], bounds[LEFT]:bounds[RIGHT]] = world.code(tile)
+        return
     for y in range(bounds[TOP], bounds[BOTTOM]):
         for x in range(bounds[LEFT], bounds[RIGHT]):
             world[y][x] = tile
 
 def fillLineH(world, tile, startX, endX, yPos, firstTile = None, lastTile = None):
-    if DEBUG_H_PATHS:
-        print(f"Horizontal:\tY: ({yPos}), X: ({startX}-{endX}), start tile: \'{firstTile}\', end tile: \'{lastTile}\'")
     if firstTile == None:
         firstTile = tile
     if lastTile == None:
         lastTile = tile
+    if isinstance(world, ArrayWorld):
+        if endX > startX:
+            row = world.tiles[yPos]
+            row[startX:endX] = world.code(tile)
+            row[endX - 1] = world.code(lastTile)
+            row[startX] = world.code(firstTile)
+        return
     end = endX - startX - 1
     count = 0
     for x in range(startX, endX):
@@ -156,12 +457,17 @@ def fillLineH(world, tile, startX, endX, yPos, firstTile = None, lastTile = None
         count += 1
 
 def fillLineV(world, tile, startY, endY, xPos, firstTile = None, lastTile = None):
-    if DEBUG_V_PATHS:
-        print(f"Vertical:\tY: ({startY}-{endY}), X: ({xPos}), start tile: \'{firstTile}\', end tile: \'{lastTile}\'")
     if firstTile == None:
         firstTile = tile
     if lastTile == None:
         lastTile = tile
+    if isinstance(world, ArrayWorld):
+        if endY > startY:
+            column = world.tiles[:, xPos]
+            column[startY:endY] = world.code(tile)
+            column[endY - 1] = world.code(lastTile)
+            column[startY] = world.code(firstTile)
+        return
     end = endY - startY - 1
     count = 0
     for y in range(startY, endY):
@@ -175,6 +481,21 @@ def fillLineV(world, tile, startY, endY, xPos, firstTile = None, lastTile = None
 
 # Intersection checks
 
+# Overlap of two bounds, with the right and bottom edges excluded like fill(),
+# or None if they don't overlap
+def clipBounds(bounds, clip):
+    left = max(bounds[LEFT], clip[LEFT])
+    top = max(bounds[TOP], clip[TOP])
+    right = min(bounds[RIGHT], clip[RIGHT])
+    bottom = min(bounds[BOTTOM], clip[BOTTOM])
+    if left >= right or top >= bottom:
+        return None
+    return [left, top, right, bottom]
+
+# Whether a (y, x) tile is within bounds, excluding the right and bottom edges
+def insideBounds(coords, bounds):
+    return bounds[TOP] <= coords[0] < bounds[BOTTOM] and bounds[LEFT] <= coords[1] < bounds[RIGHT]
+
 def intersectRect(ba, bb):
     return not (ba[LEFT] > bb[RIGHT] or ba[RIGHT] < bb[LEFT] or \
                 ba[TOP] > bb[BOTTOM] or ba[BOTTOM] < bb[TOP])
@@ -184,186 +505,698 @@ def intersectRectPoint(rect, point):
     Y = 1
     # Technically RIGHT and BOTTOM should be compared with > and not >=.
     # This was done because some paths will allow access to rooms without opening a door.
-    # TODO: make an actual rectangle-path intersection algorithm
     return rect[LEFT] <= point[X] and rect[TOP] <= point[Y] and rect[RIGHT] >= point[X] and rect[BOTTOM] >= point[Y]
 
+# Bounds covering a line between two points, inclusive like room bounds
+def lineBounds(startPoint, endPoint):
+    return (min(startPoint[0], endPoint[0]), min(startPoint[1], endPoint[1]),
+            max(startPoint[0], endPoint[0]), max(startPoint[1], endPoint[1]))
+
+# Corridors are always horizontal or vertical, so a line is its own bounding
+# box and this catches lines passing straight through a room, not just ones
+# ending inside it. Uses the same inclusive edges as intersectRectPoint.
 def intersectRectLine(rect, startPoint, endPoint):
-    return intersectRectPoint(rect, startPoint) or intersectRectPoint(rect, endPoint)
+    return intersectRect(rect, lineBounds(startPoint, endPoint))
 
-def intersectLineH(world, rooms, roomCount, startX, endX, yPos, roomE, roomE2):
-    for ri in range(0, roomCount):
-        if ri == roomE or ri == roomE2:
-            continue
-        
-        room = rooms[ri]
-        roomBounds = room.bounds
+# Spatial index
+
+# Uniform bucket grid over room bounds. Buckets are sized to the largest normal
+# room, so a candidate room only has to be checked against the handful of rooms
+# sharing its buckets instead of every room placed so far. Bounds are inserted
+# inclusively on every side to match intersectRect, which counts touching edges.
+class RoomGrid:
+    def __init__(self, cellWidth, cellHeight):
+        self.cellWidth = max(1, cellWidth)
+        self.cellHeight = max(1, cellHeight)
+        self.buckets = {}
+    
+    def _cells(self, bounds):
+        for cy in range(bounds[TOP] // self.cellHeight, bounds[BOTTOM] // self.cellHeight + 1):
+            for cx in range(bounds[LEFT] // self.cellWidth, bounds[RIGHT] // self.cellWidth + 1):
+                yield (cx, cy)
+    
+    def insert(self, index, bounds):
+        for cell in self._cells(bounds):
+            bucket = self.buckets.get(cell)
+            if bucket is None:
+                self.buckets[cell] = [(index, bounds)]
+            else:
+                bucket.append((index, bounds))
+    
+    def query(self, bounds):
+        seen = set()
+        for cell in self._cells(bounds):
+            for entry in self.buckets.get(cell, ()):
+                if entry[0] not in seen:
+                    seen.add(entry[0])
+                    yield entry
+    
+    def remove(self, index, bounds):
+        for cell in self._cells(bounds):
+            bucket = self.buckets.get(cell)
+            if bucket is not None and (index, bounds) in bucket:
+                bucket.remove((index, bounds))
+    
+    def intersects(self, bounds):
+        for index, other in self.query(bounds):
+            if intersectRect(other, bounds):
+                return True
+        return False
+
+# Free space tracking for packed placement. Each row is a bitmask of occupied
+# coordinates, with rooms marked inclusively like intersectRect. Finding every
+# spot a room fits in is a handful of big integer shifts and ANDs per row, so it
+# costs the same however many rooms have already been placed.
+class OccupancyMap:
+    def __init__(self, width, height):
+        # Bounds can sit on the far edge of the world, so that needs a bit too
+        self.width = width + 1
+        self.rows = [0] * (height + 1)
+        self.full = (1 << self.width) - 1
+    
+    def insert(self, bounds):
+        mask = ((1 << (bounds[RIGHT] - bounds[LEFT] + 1)) - 1) << bounds[LEFT]
+        for y in range(bounds[TOP], bounds[BOTTOM] + 1):
+            self.rows[y] |= mask
+    
+    # For every top from 0 to maxTop, a mask of the lefts from 0 to maxLeft
+    # where bounds of this size wouldn't touch anything already placed
+    def fits(self, width, height, maxLeft, maxTop):
+        if maxLeft < 0 or maxTop < 0:
+            return []
+        lefts = (1 << (maxLeft + 1)) - 1
+        rowFits = []
+        for row in self.rows[:maxTop + height + 1]:
+            free = ~row & self.full
+            fit = free
+            for shift in range(1, width + 1):
+                fit &= free >> shift
+            rowFits.append(fit & lefts)
         
-        if intersectRectLine(roomBounds, (startX, yPos), (endX, yPos)):
-            if DEBUG_H_PATHS:
-                print(f"Horizontal intersection. Line: Y: ({yPos}) X: ({startX}-{endX}) Room: #{ri} {roomBounds}")
-            return True
+        result = []
+        for top in range(maxTop + 1):
+            fit = rowFits[top]
+            for y in range(top + 1, top + height + 1):
+                fit &= rowFits[y]
+            result.append(fit)
+        return result
     
-    return False
+    # Picks a random free (left, top), or None if there isn't one
+    def sample(self, rng, width, height, maxLeft, maxTop):
+        fits = self.fits(width, height, maxLeft, maxTop)
+        total = sum(fit.bit_count() for fit in fits)
+        if total == 0:
+            return None
+        
+        pick = rng.randrange(total)
+        for top, fit in enumerate(fits):
+            count = fit.bit_count()
+            if pick >= count:
+                pick -= count
+                continue
+            for i in range(pick):
+                fit &= fit - 1
+            return ((fit & -fit).bit_length() - 1, top)
+
+# Places one room of the given type wherever it still fits. If the size it
+# picked fits nowhere, it tries its minimum size, then each fallback type.
+def packRoom(config, occupancy, data, rng, fallbacks = ()):
+    for roomData in (data,) + tuple(fallbacks):
+        room = roomData.newRoom(config)
+        for size in (room.generateSize(rng), room.minimumSize()):
+            if size is None:
+                continue
+            width, height = size
+            position = occupancy.sample(rng, width, height, *room.positionRange(width, height))
+            if position is not None:
+                room.generateAt(rng, position[0], position[1], width, height)
+                return room
+    return None
 
-def intersectLineV(world, rooms, roomCount, startY, endY, xPos, roomE, roomE2):
-    for ri in range(0, roomCount):
+# Line checks only look at rooms sharing grid buckets with the line,
+# ignoring the two rooms the corridor is meant to connect.
+
+def intersectLine(roomGrid, startPoint, endPoint, roomE, roomE2):
+    for ri, roomBounds in roomGrid.query(lineBounds(startPoint, endPoint)):
         if ri == roomE or ri == roomE2:
             continue
         
-        room = rooms[ri]
-        roomBounds = room.bounds
-        
-        if intersectRectLine(roomBounds, (xPos, startY), (xPos, endY)):
-            if DEBUG_V_PATHS:
-                print(f"Vertical intersection. Line: Y: ({startY}-{endY}) X: ({xPos}) Room: #{ri} {roomBounds}")
+        if intersectRectLine(roomBounds, startPoint, endPoint):
             return True
     
     return False
 
+def intersectLineH(roomGrid, startX, endX, yPos, roomE, roomE2):
+    return intersectLine(roomGrid, (startX, yPos), (endX, yPos), roomE, roomE2)
+
+def intersectLineV(roomGrid, startY, endY, xPos, roomE, roomE2):
+    return intersectLine(roomGrid, (xPos, startY), (xPos, endY), roomE, roomE2)
+
+# Instrumentation
+
+# Counters, histograms and an optional event stream for one generation run.
+# Pass one to generate() to fill it in. Nothing is recorded per tile, only per
+# room, edge and corridor, and generate() skips all of it when no trace is given.
+class Trace:
+    def __init__(self, events = False, sink = None, kinds = None):
+        self.counters = {}
+        self.histograms = {}# name -> {value: count}
+        # Events are dicts with an "event" key naming them. They're kept in
+        # events if requested, and handed to sink as they happen.
+        self.events = [] if events else None
+        self.sink = sink
+        self.kinds = None if kinds is None else set(kinds)
+        self.recordEvents = events or sink is not None
+    
+    def count(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {}
+        histogram[value] = histogram.get(value, 0) + 1
+    
+    def wants(self, kind):
+        return self.recordEvents and (self.kinds is None or kind in self.kinds)
+    
+    def event(self, kind, **fields):
+        if not self.wants(kind):
+            return
+        fields["event"] = kind
+        if self.events is not None:
+            self.events.append(fields)
+        if self.sink is not None:
+            self.sink(fields)
+    
+    def printStats(self):
+        print("Counters:")
+        for name in sorted(self.counters):
+            print(f"\t{name}: {self.counters[name]}")
+        print("Histograms:")
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            print(f"\t{name}: " + ", ".join(f"{value}: {histogram[value]}" for value in sorted(histogram)))
+
+def printEvent(event):
+    fields = ", ".join(f"{key}: {value}" for key, value in event.items() if key != "event")
+    print(f"[{event['event']}] {fields}")
+
 # World print
 
+# Writes rows of tiles into one preallocated buffer, each followed by a newline.
+# prefixes, if given, holds bytes to put in front of each row. Doubling uses
+# extended slice assignment, so no Python code runs per tile.
+def renderRows(rows, width, prefixes = None, doubled = False, header = b''):
+    rowWidth = 2 * width if doubled else width
+    size = len(header) + len(rows) * (rowWidth + 1)
+    if prefixes is not None:
+        size += sum(len(prefix) for prefix in prefixes)
+    
+    buffer = bytearray(size)
+    buffer[:len(header)] = header
+    pos = len(header)
+    for y, row in enumerate(rows):
+        if prefixes is not None:
+            prefix = prefixes[y]
+            buffer[pos:pos + len(prefix)] = prefix
+            pos += len(prefix)
+        data = row.encode('latin-1')
+        if doubled:
+            buffer[pos:pos + rowWidth:2] = data
+            buffer[pos + 1:pos + rowWidth:2] = data
+        else:
+            buffer[pos:pos + rowWidth] = data
+        pos += rowWidth
+        buffer[pos] = 10
+        pos += 1
+    return buffer
+
+# Rows of the world with an axis header and row numbers, and the X axis doubled
+# up so that things look more square
+def renderAxes(rows, height, width):
+    header = ("\t\t" + "".join(f"{i*4}\t" for i in range(0, int(width / 4))) + "\n" +
+              "\t\t" + "|\t" * int(width / 4) + "\n").encode()
+    prefixes = [f"{y}\t\t".encode() for y in range(height)]
+    return renderRows(list(rows), width, prefixes, True, header)
+
 def printWorld(world, height, width):
-    print("\t\t", end = "")
-        
-    for i in range(0, int(width / 4)):
-        print(f"{i*4}\t", end = "")
-    print()
-    print("\t\t", end = "")
-    for i in range(0, int(width / 4)):
-        print("|\t", end = "")
+    sys.stdout.write(renderAxes(worldRows(world), height, width).decode('latin-1'))
+
+# Works for dungeons with or without a grid
+def printDungeon(dungeon):
+    config = dungeon.config
+    sys.stdout.write(renderAxes(dungeon.rows(), config.worldHeight, config.worldWidth).decode('latin-1'))
+
+# Content placement
+#
+# Decor and stairs each go on their own tile. Tiles are drawn without
+# replacement from a room's free tiles, so nothing lands on top of anything
+# else and every item that was asked for gets placed.
+
+# The free tiles of some bounds, right and bottom edges excluded like fill().
+# It's a Fisher-Yates shuffle that stores only the entries it has moved, so
+# setting one up is free, and drawing or taking a tile is O(1) no matter how
+# big the area is.
+class FreeCells:
+    __slots__ = ('left', 'top', 'width', 'height', 'free', 'values', 'indices')
+    
+    def __init__(self, bounds):
+        self.left = bounds[LEFT]
+        self.top = bounds[TOP]
+        self.width = max(bounds[RIGHT] - bounds[LEFT], 0)
+        self.height = max(bounds[BOTTOM] - bounds[TOP], 0)
+        # Cells are numbered row by row, and the ones at [0, free) are free
+        self.free = self.width * self.height
+        self.values = {}# index -> cell, where they differ
+        self.indices = {}# cell -> index, where they differ
+    
+    def __len__(self):
+        return self.free
+    
+    def _cell(self, coords):
+        y = coords[0] - self.top
+        x = coords[1] - self.left
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return None
+    
+    def _remove(self, index):
+        last = self.free - 1
+        cell = self.values.get(index, index)
+        lastCell = self.values.get(last, last)
+        self.values[index] = lastCell
+        self.indices[lastCell] = index
+        self.values[last] = cell
+        self.indices[cell] = last
+        self.free = last
+        return cell
+    
+    def isFree(self, coords):
+        cell = self._cell(coords)
+        return cell is not None and self.indices.get(cell, cell) < self.free
+    
+    # Marks a tile as used. Returns False if it was already used.
+    def take(self, coords):
+        if not self.isFree(coords):
+            return False
+        cell = self._cell(coords)
+        self._remove(self.indices.get(cell, cell))
+        return True
+    
+    # Uses up a random free tile and returns it as (y, x), or None if there are none
+    def pop(self, rng):
+        if self.free == 0:
+            return None
+        cell = self._remove(rng.randrange(self.free))
+        return (self.top + cell // self.width, self.left + cell % self.width)
+
+# Tiles stairs can go on, which keeps them off the room's outer ring
+def stairBounds(bounds):
+    return [bounds[LEFT] + 1, bounds[TOP] + 1, bounds[RIGHT] - 1, bounds[BOTTOM] - 1]
+
+# Yields the items in random order, only drawing each one when it's needed
+def shuffled(items, rng):
+    order = FreeCells([0, 0, len(items), 1])
+    while order:
+        yield items[order.pop(rng)[1]]
+
+# Rooms to try the stairs in: leaves of the spanning tree in random order, then
+# the rest in case none of those have space. There's always a leaf, since the
+# tree can't have cycles. The up-stairs room is left out.
+def stairCandidates(dungeon, rng):
+    rooms = [i for i in range(dungeon.roomCount) if i != dungeon.upStairRoom]
+    yield from shuffled([i for i in rooms if dungeon.doorCounts[i] == 1], rng)
+    yield from shuffled([i for i in rooms if dungeon.doorCounts[i] != 1], rng)
+
+# Room shapes
+#
+# Rooms that aren't plain rectangles stamp a precomputed template instead of
+# working out every tile as they're drawn. A template only depends on a few
+# numbers, like a boss room's radius, and there are only a handful of those per
+# config, so each one is built the first time it's needed and cached. The cache
+# is bounded, since a long running process can go through many configs.
+
+SHAPE_TEMPLATES = OrderedDict()# key -> ShapeTemplate, most recently used last
+SHAPE_TEMPLATE_LIMIT = 512
+
+# rows holds the tile for every cell of a width x height area. boxes and
+# doorBoxes are bounds relative to its top left corner, and blocked lists the
+# (y, x) cells that aren't floor, so decor and stairs stay off them.
+class ShapeTemplate:
+    __slots__ = ('width', 'height', 'rows', 'boxes', 'doorBoxes', 'blocked', 'chars')
+    
+    def __init__(self, rows, floorTile, boxes = (), doorBoxes = ()):
+        self.width = len(rows[0])
+        self.height = len(rows)
+        self.rows = tuple(rows)
+        self.boxes = tuple(boxes)
+        self.doorBoxes = tuple(doorBoxes)
+        self.blocked = tuple((y, x) for y, row in enumerate(rows) for x, tile in enumerate(row) if tile != floorTile)
+        self.chars = None
+    
+    # The rows as a 2D uint8 array of characters, for stamping numpy worlds
+    def charArray(self):
+        if self.chars is None:
+            data = ''.join(self.rows).encode('latin-1')
+            self.chars = numpy.frombuffer(data, dtype = numpy.uint8).reshape(self.height, self.width)
+        return self.chars
+
+def shapeTemplate(key, build):
+    template = SHAPE_TEMPLATES.get(key)
+    if template is not None:
+        SHAPE_TEMPLATES.move_to_end(key)
+        return template
+    
+    template = SHAPE_TEMPLATES[key] = build()
+    while len(SHAPE_TEMPLATES) > SHAPE_TEMPLATE_LIMIT:
+        SHAPE_TEMPLATES.popitem(last = False)
+    return template
+
+# Moves bounds relative to a template to where it's placed
+def offsetBounds(bounds, left, top):
+    return [bounds[LEFT] + left, bounds[TOP] + top, bounds[RIGHT] + left, bounds[BOTTOM] + top]
+
+# Draws the part of a template placed at (left, top) that's inside area.
+# List worlds take whole row slices, and numpy worlds one lookup per stamp.
+def stamp(world, template, left, top, area):
+    rows = slice(area[TOP] - top, area[BOTTOM] - top)
+    columns = slice(area[LEFT] - left, area[RIGHT] - left)
+    if isinstance(world, ArrayWorld):
+        lookup = numpy.zeros(256, dtype = numpy.uint8)
+        for tile in set(''.join(template.rows)):
+            lookup[ord(tile)] = world.code(tile)
+        world.tiles[area[TOP]:area[BOTTOM], area[LEFT]:area[RIGHT]] = lookup[template.charArray()[rows, columns]]
+        return
+    for y, row in zip(range(area[TOP], area[BOTTOM]), template.rows[rows]):
+        world[y][area[LEFT]:area[RIGHT]] = row[columns]
+
+# A circle of floor inside walls, with a box of floor reaching out to each side
+# that holds a door. Cells within the radius of the middle are floor, and the
+# boxes are drawn over the top.
+def _buildBossShape(config, radius, width, height):
+    halfSizeX = width // 2
+    halfSizeY = height // 2
+    middle = (halfSizeY, halfSizeX)
+    
+    topCube = [halfSizeX - ceil(config.minRoomWidth / 2), 0, halfSizeX + ceil(config.minRoomWidth / 2) + 1, config.minRoomHeight + 1]
+    leftCube = [0, halfSizeY - ceil(config.minRoomHeight / 2), config.minRoomWidth + 1, halfSizeY + ceil(config.minRoomWidth / 2) + 1]
+    bottomCube = [topCube[LEFT], height - config.minRoomHeight, topCube[RIGHT], height]
+    rightCube = [width - config.minRoomWidth, leftCube[TOP], width, leftCube[BOTTOM]]
+    boxes = [leftCube, topCube, rightCube, bottomCube]
     
-    print()
+    doorBoxes = [list(box) for box in boxes]
+    doorBoxes[LEFT][RIGHT] = leftCube[LEFT] + 1
+    doorBoxes[TOP][BOTTOM] = topCube[TOP] + 1
+    doorBoxes[RIGHT][LEFT] = rightCube[RIGHT] - 1
+    doorBoxes[BOTTOM][TOP] = bottomCube[BOTTOM] - 1
     
-    for y in range(0, height):
-        # Double up the X axis so that things look more square
-        print(f"{y}\t\t" + ''.join([val for pair in zip(world[y], world[y]) for val in pair]))
+    tiles = [[config.roomTile if distEuclid((y, x), middle) <= radius else config.bossWallTile for x in range(width)]
+             for y in range(height)]
+    for box in boxes:
+        box = clipBounds(box, [0, 0, width, height])
+        if box is not None:
+            fill(tiles, config.roomTile, box)
+    
+    return ShapeTemplate([''.join(row) for row in tiles], config.roomTile, boxes, doorBoxes)
+
+def bossShape(config, radius, width, height):
+    key = ("boss", radius, width, height, config.minRoomWidth, config.minRoomHeight, config.roomTile, config.bossWallTile)
+    return shapeTemplate(key, lambda : _buildBossShape(config, radius, width, height))
+
+# Runs of floor along each side of some art, as one tile deep door boxes
+def _edgeDoors(art, floorTile):
+    width = len(art[0])
+    height = len(art)
+    sides = [[(y, 0) for y in range(height)], [(0, x) for x in range(width)],
+             [(y, width - 1) for y in range(height)], [(height - 1, x) for x in range(width)]]
+    doors = []
+    for cells in sides:
+        runs = [[]]
+        for y, x in cells:
+            if art[y][x] == floorTile:
+                runs[-1].append((y, x))
+            elif runs[-1]:
+                runs.append([])
+        for run in runs:
+            if run:
+                doors.append([run[0][1], run[0][0], run[-1][1] + 1, run[-1][0] + 1])
+    return doors
+
+def _buildPrefabShape(config, art):
+    floorTile = config.roomTile
+    rows = [''.join(config.solidTile if char == '#' else floorTile for char in line) for line in art]
+    doorBoxes = _edgeDoors(rows, floorTile)
+    # Corridors can only reach a room through its doors
+    if not doorBoxes:
+        raise ValueError("Prefab art needs floor on its edge for doors")
+    return ShapeTemplate(rows, floorTile, doorBoxes = doorBoxes)
+
+def prefabShape(config, art):
+    key = ("prefab", tuple(art), config.roomTile, config.solidTile)
+    return shapeTemplate(key, lambda : _buildPrefabShape(config, art))
 
 # Classes
 
 class Room:
-    def __init__(self):
+    __slots__ = ('config', 'bounds', 'doorBounds', 'tile', 'maxDoors', 'decor', 'chestCount', 'monsterCount', 'stairCell')
+    
+    def __init__(self, config):
+        self.config = config
         self.bounds = [0] * 4
         self.doorBounds = [None]
-        self.tile = roomTile
+        self.tile = config.roomTile
         self.maxDoors = 3
         self.decor = {}
+        self.chestCount = 0
+        self.monsterCount = 0
+        self.stairCell = None# (y, x) kept free in case this room gets the stairs
     
     def generate(self, rng):
-        self.bounds[LEFT] = rng.randrange(0, WORLD_WIDTH - MAX_ROOM_WIDTH)
-        self.bounds[TOP] = rng.randrange(0, WORLD_HEIGHT - MAX_ROOM_HEIGHT)
-        self.bounds[RIGHT] = min(self.bounds[LEFT] + rng.randrange(MIN_ROOM_WIDTH, MAX_ROOM_WIDTH), WORLD_WIDTH)
-        self.bounds[BOTTOM] = min(self.bounds[TOP] + rng.randrange(MIN_ROOM_HEIGHT, MAX_ROOM_HEIGHT), WORLD_HEIGHT)
+        config = self.config
+        left = rng.randrange(0, config.worldWidth - config.maxRoomWidth)
+        top = rng.randrange(0, config.worldHeight - config.maxRoomHeight)
+        width, height = self.generateSize(rng)
+        self.generateAt(rng, left, top, width, height)
+    
+    # Picks the room's size, as the distance between its bounds
+    def generateSize(self, rng):
+        config = self.config
+        return (rng.randrange(config.minRoomWidth, config.maxRoomWidth),
+                rng.randrange(config.minRoomHeight, config.maxRoomHeight))
+    
+    # The smallest size to fall back on when the generated one doesn't fit anywhere
+    def minimumSize(self):
+        return (self.config.minRoomWidth, self.config.minRoomHeight)
+    
+    # Largest left and top this room can be placed at with the given size
+    def positionRange(self, width, height):
+        return (self.config.worldWidth - width, self.config.worldHeight - height)
+    
+    def generateAt(self, rng, left, top, width, height):
+        config = self.config
+        self.bounds[LEFT] = left
+        self.bounds[TOP] = top
+        self.bounds[RIGHT] = min(left + width, config.worldWidth)
+        self.bounds[BOTTOM] = min(top + height, config.worldHeight)
         
         self.doorBounds[0] = self.bounds
         
-        if DEBUG_ROOM_GEN:
-            print(self.bounds)
-        
-        self.decor = {}
-        self.chestCount = rng.randrange(MIN_CHEST_COUNT, MAX_CHEST_COUNT)
-        self.monsterCount = rng.randrange(MIN_MONSTER_COUNT, MAX_MONSTER_COUNT)
+        self.placeDecor(rng)
+    
+    # Keeps a tile free for stairs, then places decor on distinct free tiles.
+    # Decor covers at most decorDensity of the room. Monsters are placed first,
+    # so if both don't fit it's the chests that are cut short.
+    def placeDecor(self, rng):
+        config = self.config
+        cells = FreeCells(self.bounds)
+        stairCells = FreeCells(stairBounds(self.bounds))
+        for coords in self.blockedCells():
+            cells.take(coords)
+            stairCells.take(coords)
         
-        for i in range(self.monsterCount):
-            coords = (rng.randrange(self.bounds[TOP], self.bounds[BOTTOM]), rng.randrange(self.bounds[LEFT], self.bounds[RIGHT]))
-            self.decor[coords] = monsterTile
+        self.stairCell = stairCells.pop(rng)
+        if self.stairCell is not None:
+            cells.take(self.stairCell)
         
-        for i in range(self.chestCount):
-            coords = (rng.randrange(self.bounds[TOP], self.bounds[BOTTOM]), rng.randrange(self.bounds[LEFT], self.bounds[RIGHT]))
-            self.decor[coords] = chestTile
+        budget = min(int(len(cells) * config.decorDensity), len(cells))
+        self.monsterCount = min(rng.randrange(config.minMonsterCount, config.maxMonsterCount), budget)
+        self.chestCount = min(rng.randrange(config.minChestCount, config.maxChestCount), budget - self.monsterCount)
         
-    def populate(self, world):
-        fill(world, self.tile, self.bounds)
+        self.decor = {}
+        for tile, count in ((config.monsterTile, self.monsterCount), (config.chestTile, self.chestCount)):
+            for i in range(count):
+                self.decor[cells.pop(rng)] = tile
+    
+    # Cells inside the bounds that aren't floor
+    def blockedCells(self):
+        return ()
     
-    def populateDecor(self, world):
+    # clip limits drawing to part of the world, for redrawing after an edit
+    def populate(self, world, clip = None):
+        bounds = self.bounds if clip is None else clipBounds(self.bounds, clip)
+        if bounds is not None:
+            fill(world, self.tile, bounds)
+    
+    def populateDecor(self, world, clip = None):
         for coords in self.decor:
-            world[coords[0]][coords[1]] = self.decor[coords]
-
-    def addStairs(self, world):
-        y = random.randrange(self.bounds[TOP] + 1, self.bounds[BOTTOM] - 1)
-        x = random.randrange(self.bounds[LEFT] + 1, self.bounds[RIGHT] - 1)
-        for obj in self.decor:
-            if (y, x) == obj:
-                return False
-        world[y][x] = stairTile
-        return True
+            if clip is None or insideBounds(coords, clip):
+                setTile(world, coords[0], coords[1], self.decor[coords])
+
+    # The tile populate() and populateDecor() leave at (y, x), which has to be
+    # inside the room's bounds, or None if they leave it as it was
+    def drawnTile(self, y, x):
+        config = self.config
+        if config.featureRoomDecor:
+            tile = self.decor.get((y, x))
+            if tile is not None:
+                return tile
+        return self.tile if config.featureRooms else None
+    
+    # Where the stairs go if this room gets them, as (y, x), or None if the room
+    # is too small to have a tile for them
+    def stairPosition(self):
+        return self.stairCell
 
 class BossRoom(Room):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ('radius', 'center', 'boxes', 'template')
+    
+    def __init__(self, config):
+        super().__init__(config)
         self.radius = 0.0
         self.center = (0, 0)
         self.maxDoors = 2
         self.boxes = []
+        self.template = None
     
     def generate(self, rng):
-        self.radius = floor(rng.uniform(MIN_BOSS_RADIUS, MAX_BOSS_RADIUS))
+        config = self.config
+        width, height = self.generateSize(rng)
+        halfSizeY = height // 2
+        halfSizeX = width // 2
         
-        sizeY = round(2 * MIN_ROOM_HEIGHT + 2 * self.radius)
-        sizeX = round(2 * MIN_ROOM_WIDTH + 2 * self.radius)
+        centerY = rng.randrange(halfSizeY, config.worldHeight - halfSizeY)
+        centerX = rng.randrange(halfSizeX, config.worldWidth - halfSizeX)
+        
+        self.generateAt(rng, centerX - halfSizeX, centerY - halfSizeY, width, height)
+    
+    def generateSize(self, rng):
+        config = self.config
+        self.radius = floor(rng.uniform(config.minBossRadius, config.maxBossRadius))
+        
+        sizeY = round(2 * config.minRoomHeight + 2 * self.radius)
+        sizeX = round(2 * config.minRoomWidth + 2 * self.radius)
         halfSizeY = floor(sizeY / 2)
         halfSizeX = floor(sizeX / 2)
         
-        centerY = rng.randrange(halfSizeY, WORLD_HEIGHT - halfSizeY)
-        centerX = rng.randrange(halfSizeX, WORLD_WIDTH - halfSizeX)
-        
-        self.center = (centerY, centerX)
-        
-        self.bounds[TOP] = centerY - halfSizeY
-        self.bounds[LEFT] = centerX - halfSizeX
-        self.bounds[BOTTOM] = centerY + halfSizeY
-        self.bounds[RIGHT] = centerX + halfSizeX
-        
-        topCube = [0] * 4
-        leftCube = [0] * 4
-        bottomCube = [0] * 4
-        rightCube = [0] * 4
-        
-        topCube[LEFT] = centerX - (ceil((MIN_ROOM_WIDTH) / 2))
-        topCube[TOP] = self.bounds[TOP]
-        topCube[RIGHT] = centerX + (ceil((MIN_ROOM_WIDTH) / 2)) + 1
-        topCube[BOTTOM] = topCube[TOP] + MIN_ROOM_HEIGHT + 1
-        
-        leftCube[LEFT] = self.bounds[LEFT]
-        leftCube[TOP] = centerY - (ceil((MIN_ROOM_HEIGHT) / 2))
-        leftCube[RIGHT] = leftCube[LEFT] + MIN_ROOM_WIDTH + 1
-        leftCube[BOTTOM] = centerY + (ceil((MIN_ROOM_WIDTH) / 2)) + 1
-        
-        bottomCube[LEFT] = topCube[LEFT]
-        bottomCube[TOP] = self.bounds[BOTTOM] - MIN_ROOM_HEIGHT
-        bottomCube[RIGHT] = topCube[RIGHT]
-        bottomCube[BOTTOM] = self.bounds[BOTTOM]
-        
-        rightCube[LEFT] = self.bounds[RIGHT] - MIN_ROOM_WIDTH
-        rightCube[TOP] = leftCube[TOP]
-        rightCube[RIGHT] = self.bounds[RIGHT]
-        rightCube[BOTTOM] = leftCube[BOTTOM]
-        
-        self.boxes = [leftCube, topCube, rightCube, bottomCube]
-        
-        self.doorBounds = deepcopy(self.boxes)
-        self.doorBounds[LEFT][RIGHT] = leftCube[LEFT] + 1
-        self.doorBounds[TOP][BOTTOM] = topCube[TOP] + 1
-        self.doorBounds[RIGHT][LEFT] = rightCube[RIGHT] - 1
-        self.doorBounds[BOTTOM][TOP] = bottomCube[BOTTOM] - 1
-    
-    def populate(self, world):
-        for y in range(self.bounds[TOP], self.bounds[BOTTOM]):
-            for x in range(self.bounds[LEFT], self.bounds[RIGHT]):
-                if distEuclid((y, x), self.center) <= self.radius:
-                    world[y][x] = self.tile
-                else:
-                    world[y][x] = bossWallTile
+        return (2 * halfSizeX, 2 * halfSizeY)
+    
+    # The circle can't shrink without changing the radius
+    def minimumSize(self):
+        return None
+    
+    def positionRange(self, width, height):
+        # Centers are picked from [half, world - half), so the far edge stops one short
+        return (self.config.worldWidth - width - 1, self.config.worldHeight - height - 1)
+    
+    def generateAt(self, rng, left, top, width, height):
+        halfSizeY = height // 2
+        halfSizeX = width // 2
+        self.template = bossShape(self.config, self.radius, 2 * halfSizeX, 2 * halfSizeY)
+        
+        self.center = (top + halfSizeY, left + halfSizeX)
         
-        for bound in self.boxes:
-            fill(world, self.tile, bound)
+        self.bounds[LEFT] = left
+        self.bounds[TOP] = top
+        self.bounds[RIGHT] = left + 2 * halfSizeX
+        self.bounds[BOTTOM] = top + 2 * halfSizeY
+        
+        self.boxes = [offsetBounds(box, left, top) for box in self.template.boxes]
+        self.doorBounds = [offsetBounds(box, left, top) for box in self.template.doorBoxes]
+    
+    def populate(self, world, clip = None):
+        area = self.bounds if clip is None else clipBounds(self.bounds, clip)
+        if area is not None:
+            stamp(world, self.template, self.bounds[LEFT], self.bounds[TOP], area)
     
-    def populateDecor(self, world):
-        world[self.center[0]][self.center[1]] = bossTile
+    def populateDecor(self, world, clip = None):
+        if clip is None or insideBounds(self.center, clip):
+            setTile(world, self.center[0], self.center[1], self.config.bossTile)
 
-    def addStairs(self, world):
-        return False
+    def drawnTile(self, y, x):
+        config = self.config
+        if config.featureRoomDecor and (y, x) == self.center:
+            return config.bossTile
+        if not config.featureRooms:
+            return None
+        return self.template.rows[y - self.bounds[TOP]][x - self.bounds[LEFT]]
+    
+    def stairPosition(self):
+        return None
+
+# A room drawn from fixed art, one string per row, where '#' is left as solid
+# rock and anything else is floor. Floor reaching the edge of the art makes a
+# door, one for each run of it along a side. Add a shape by subclassing this
+# with the art as PREFAB and putting it in ROOM_TABLE.
+class PrefabRoom(Room):
+    __slots__ = ('template',)
+    
+    def __init__(self, config):
+        super().__init__(config)
+        self.template = prefabShape(config, self.PREFAB)
+        self.maxDoors = len(self.template.doorBoxes)
+    
+    def generate(self, rng):
+        width, height = self.generateSize(rng)
+        maxLeft, maxTop = self.positionRange(width, height)
+        self.generateAt(rng, rng.randrange(0, maxLeft + 1), rng.randrange(0, maxTop + 1), width, height)
+    
+    def generateSize(self, rng):
+        return (self.template.width, self.template.height)
+    
+    # The art is the only size there is
+    def minimumSize(self):
+        return None
+    
+    def generateAt(self, rng, left, top, width, height):
+        super().generateAt(rng, left, top, width, height)
+        self.doorBounds = [offsetBounds(box, left, top) for box in self.template.doorBoxes]
+    
+    def blockedCells(self):
+        top = self.bounds[TOP]
+        left = self.bounds[LEFT]
+        return [(top + y, left + x) for y, x in self.template.blocked]
+    
+    def populate(self, world, clip = None):
+        area = self.bounds if clip is None else clipBounds(self.bounds, clip)
+        if area is not None:
+            stamp(world, self.template, self.bounds[LEFT], self.bounds[TOP], area)
+    
+    def drawnTile(self, y, x):
+        config = self.config
+        if config.featureRoomDecor:
+            tile = self.decor.get((y, x))
+            if tile is not None:
+                return tile
+        if not config.featureRooms:
+            return None
+        return self.template.rows[y - self.bounds[TOP]][x - self.bounds[LEFT]]
+
+class CrossRoom(PrefabRoom):
+    __slots__ = ()
+    
+    PREFAB = ("###  ###",
+              "###  ###",
+              "###  ###",
+              "        ",
+              "        ",
+              "###  ###",
+              "###  ###",
+              "###  ###")
     
 class RoomTableData:
+    __slots__ = ('newRoom', 'weight', 'perWorldMin', 'priority')
+    
     def __init__(self, factory, wt, pwm, rank):
         self.newRoom = factory
         self.weight = wt
@@ -372,333 +1205,2213 @@ class RoomTableData:
 
 # Technically should be a configuration option, but who really wants to
 # fuck with the room generation that badly? Come on min, leave it alone
+# Prefab shapes go in here like any other room, e.g. RoomTableData(CrossRoom, 5, 0, 0)
 ROOM_TABLE = [RoomTableData(Room, 90, 0, 0),
                 RoomTableData(BossRoom, 10, 1, 99)]
 
-ROOM_TABLE.sort(reverse = True, key = lambda data : data.priority)
-
-def getWeightedRoom(totalWeight):
-    weight = random.randrange(totalWeight)
-    for data in ROOM_TABLE:
+def getWeightedRoom(roomTable, totalWeight, rng):
+    weight = rng.randrange(totalWeight)
+    for data in roomTable:
         weight -= data.weight
         if weight <= 0:
             return data
     return RoomTableData(Room, 0, 0, 0)
 
-def main():
-    assert ROOM_COUNT > 1
+# Fixed stairs
+#
+# Stairs that have to line up with another floor are placed before anything
+# else, in a room built around them. Every size of room fits around a position
+# within stairArea(), and two positions that are stairsApart() can never end up
+# with overlapping rooms.
+
+def stairArea(config):
+    return [config.maxRoomWidth, config.maxRoomHeight,
+            config.worldWidth - config.maxRoomWidth, config.worldHeight - config.maxRoomHeight]
+
+def stairsApart(config, a, b):
+    return abs(a[0] - b[0]) > config.maxRoomHeight * 2 or abs(a[1] - b[1]) > config.maxRoomWidth * 2
+
+# A normal room with (y, x) as the tile it keeps for stairs. It only gets one
+# door, so like the rooms random stairs go in, it's always a leaf of the
+# spanning tree.
+def stairRoom(config, position, rng):
+    y, x = position
+    room = Room(config)
+    width, height = room.generateSize(rng)
+    width = max(width, 3)
+    height = max(height, 3)
+    room.generateAt(rng, x - rng.randrange(1, width - 1), y - rng.randrange(1, height - 1), width, height)
+    # Swap with whatever decor is in the way, keeping the counts the same
+    tile = room.decor.pop(position, None)
+    if tile is not None:
+        room.decor[room.stairCell] = tile
+    room.stairCell = position
+    room.maxDoors = 1
+    return room
+
+# Corridors
+#
+# A corridor is a list of segments, each (vertical, start, end, position,
+# firstTile, lastTile), carved with fillLineV or fillLineH in that order.
+# A path's far end can be a bare point instead of a room, with None for its
+# room index and one tile bounds, like the crossings between chunks.
+
+# Works out the corridor for one spanning tree path
+def planCorridor(config, roomGrid, p, rng, trace = None):
+    tunnelTile = config.tunnelTile
+    doorTile = config.doorTile
     
-    assert MIN_ROOM_WIDTH > 1
-    assert MIN_ROOM_HEIGHT > 1
-    assert MAX_ROOM_WIDTH > MIN_ROOM_WIDTH
-    assert MAX_ROOM_HEIGHT > MIN_ROOM_HEIGHT
+    startRoom = p[0]
+    endRoom = p[1]
     
-    assert WORLD_WIDTH >= MIN_ROOM_WIDTH
-    assert WORLD_HEIGHT >= MIN_ROOM_HEIGHT
+    startRoomIndex = startRoom[0]
+    endRoomIndex = endRoom[0]
     
-    world = _2da(WORLD_WIDTH, WORLD_HEIGHT, solidTile)
-    seed = CUSTOM_SEED if USE_CUSTOM_SEED else random.randrange(sys.maxsize)
+    startBounds = startRoom[1]
+    endBounds = endRoom[1]
     
-    print(f"Map seed (ew): {seed}")
-    random.seed(seed)
+    horTunYStart = max(startBounds[TOP], endBounds[TOP])
+    horTunYEnd = min(startBounds[BOTTOM], endBounds[BOTTOM])
+    
+    verTunXStart = max(startBounds[LEFT], endBounds[LEFT])
+    verTunXEnd = min(startBounds[RIGHT], endBounds[RIGHT])
+    
+    # vertical tunnel
+    startY = 0
+    endY = 0
+    tunnelX = 0
+    
+    # horizontal tunnel
+    startX = 0
+    startX = 0
+    tunnelY = 0
+    
+    if horTunYStart < horTunYEnd:
+        if startBounds[LEFT] > endBounds[LEFT]:
+            startX = endBounds[RIGHT]
+            endX = startBounds[LEFT]
+        else:
+            startX = startBounds[RIGHT]
+            endX = endBounds[LEFT]
+        
+        tunnelY = rng.randrange(horTunYStart, horTunYEnd)
+        
+        segments = [(False, startX, endX, tunnelY, doorTile, doorTile)]
+        
+        if trace is not None:
+            trace.count("corridors.horizontal")
+            if trace.recordEvents:
+                trace.event("path", direction = "horizontal", rooms = (startRoomIndex, endRoomIndex), y = tunnelY, x = (startX, endX))
+        
+    elif verTunXStart < verTunXEnd:
+        if startBounds[TOP] > endBounds[TOP]:
+            startY = endBounds[BOTTOM]
+            endY = startBounds[TOP]
+        else:
+            startY = startBounds[BOTTOM]
+            endY = endBounds[TOP]
+        
+        tunnelX = rng.randrange(verTunXStart, verTunXEnd)
+        
+        segments = [(True, startY, endY, tunnelX, doorTile, doorTile)]
+        
+        if trace is not None:
+            trace.count("corridors.vertical")
+            if trace.recordEvents:
+                trace.event("path", direction = "vertical", rooms = (startRoomIndex, endRoomIndex), y = (startY, endY), x = tunnelX)
+        
+    else:
+        startVertical = rng.random() > 0.5
+        
+        vStartTile = tunnelTile
+        vEndTile = tunnelTile
+        hStartTile = tunnelTile
+        hEndTile = tunnelTile
+        
+        attempts = 0
+        
+        # TODO make algorithm smarter
+        # TODO implement an optional diagonal tunnel
+        # NOTE: If the attempt count is too low, it will still intersect some rooms even if it doesn't have to.
+        # That's because it randomly selects new positions and gives up too easily.
+        while attempts < 32:
+            addOneV = startBounds[TOP] == endBounds[BOTTOM] or startBounds[BOTTOM] == endBounds[TOP]
+            addOneH = startBounds[LEFT] == endBounds[RIGHT] or startBounds[RIGHT] == endBounds[LEFT]
+            
+            startRY = insetRandrange(rng, startBounds[TOP], startBounds[BOTTOM], addOneV)
+            startRX = insetRandrange(rng, startBounds[LEFT], startBounds[RIGHT], addOneH)
+            endRY = insetRandrange(rng, endBounds[TOP], endBounds[BOTTOM], addOneV)
+            endRX = insetRandrange(rng, endBounds[LEFT], endBounds[RIGHT], addOneH)
+            
+            if startVertical:
+                startY = min(startBounds[BOTTOM], endRY)
+                endY = max(startBounds[TOP], endRY)
+                tunnelX = startRX
+                
+                startX = min(endBounds[RIGHT], tunnelX)
+                endX = max(endBounds[LEFT], startRX + 1)
+                tunnelY = endRY
+                
+                vStartTile = doorTile if startY == startBounds[BOTTOM] else tunnelTile
+                vEndTile = doorTile if endY == startBounds[TOP] else tunnelTile
+                hStartTile = doorTile if startX == endBounds[RIGHT] else tunnelTile
+                hEndTile = doorTile if endX == endBounds[LEFT] else tunnelTile
+            else:
+                startX = min(startBounds[RIGHT], endRX)
+                endX = max(startBounds[LEFT], endRX)
+                tunnelY = startRY
+                
+                startY = min(endBounds[BOTTOM], tunnelY)
+                endY = max(endBounds[TOP], startRY + 1)
+                tunnelX = endRX
+                
+                vStartTile = doorTile if startY == endBounds[BOTTOM] else tunnelTile
+                vEndTile = doorTile if endY == endBounds[TOP] else tunnelTile
+                hStartTile = doorTile if startX == startBounds[RIGHT] else tunnelTile
+                hEndTile = doorTile if endX == startBounds[LEFT] else tunnelTile
+            
+            if intersectLineV(roomGrid, startY, endY, tunnelX, startRoomIndex, endRoomIndex) or \
+               intersectLineH(roomGrid, startX, endX, tunnelY, startRoomIndex, endRoomIndex):
+                attempts += 1
+                startVertical = not startVertical
+                if trace is not None:
+                    trace.event("diagonalRetry", rooms = (startRoomIndex, endRoomIndex), attempt = attempts)
+                continue
+            # I would go ahead and cancel the tunnel if we can't find a non-intersecting path,
+            # but that would make parts of the map unobtainable without mining tools.
+            # So we just say 'sod it' and build the tunnel anyway.
+            break
+        
+        segments = [(True, startY, endY, tunnelX, vStartTile, vEndTile),
+                    (False, startX, endX, tunnelY, hStartTile, hEndTile)]
+        
+        if trace is not None:
+            trace.count("corridors.diagonal")
+            trace.observe("corridors.diagonalAttempts", attempts)
+            if attempts == 32:
+                # Gave up and dug through whatever was in the way
+                trace.count("corridors.diagonalGaveUp")
+            if trace.recordEvents:
+                trace.event("path", direction = "diagonal", rooms = (startRoomIndex, endRoomIndex), attempts = attempts,
+                            vertical = ((startY, endY), tunnelX), horizontal = (tunnelY, (startX, endX)))
+    
+    # Corridors stop short of the room they lead to, but a point has to be dug
+    if endRoomIndex is None:
+        segments.append((False, endBounds[LEFT], endBounds[RIGHT], endBounds[TOP], tunnelTile, tunnelTile))
+    
+    return segments
+
+def carveCorridor(world, config, segments, clip = None):
+    for segment in segments:
+        vertical, start, end, position, firstTile, lastTile = segment
+        if clip is not None:
+            carveClipped(world, config, segment, clip)
+        elif vertical:
+            fillLineV(world, config.tunnelTile, start, end, position, firstTile, lastTile)
+        else:
+            fillLineH(world, config.tunnelTile, start, end, position, firstTile, lastTile)
+
+# The tiles a segment covers, with the right and bottom edges excluded,
+# or None if it's empty
+def segmentBounds(segment):
+    vertical, start, end, position = segment[:4]
+    if end <= start:
+        return None
+    if vertical:
+        return [position, start, position + 1, end]
+    return [start, position, end, position + 1]
+
+# The tile a segment carves at (y, x), or None if it doesn't cover it
+def segmentTile(config, segment, y, x):
+    vertical, start, end, position, firstTile, lastTile = segment
+    along, across = (y, x) if vertical else (x, y)
+    if across != position or not start <= along < end:
+        return None
+    if along == start:
+        return firstTile
+    if along == end - 1:
+        return lastTile
+    return config.tunnelTile
+
+# Carves the part of a segment inside clip, with the same first and last
+# tiles the whole segment would have
+def carveClipped(world, config, segment, clip):
+    vertical, start, end, position, firstTile, lastTile = segment
+    bounds = segmentBounds(segment)
+    area = None if bounds is None else clipBounds(bounds, clip)
+    if area is None:
+        return
+    
+    fill(world, config.tunnelTile, area)
+    ends = [(end - 1, lastTile), (start, firstTile)]# first wins on a one tile segment
+    for along, tile in ends:
+        coords = (along, position) if vertical else (position, along)
+        if insideBounds(coords, area):
+            setTile(world, coords[0], coords[1], tile)
+
+# Library API
+
+# Field names and defaults of DungeonConfig
+_CONFIG_FIELDS = (
+    ("worldWidth",       48),
+    ("worldHeight",      256),
+    ("roomCount",        16),
+    ("minRoomWidth",     3),
+    ("minRoomHeight",    3),
+    ("maxRoomWidth",     6),
+    ("maxRoomHeight",    6),
+    ("minBossRadius",    6.5),
+    ("maxBossRadius",    14.5),
+    ("minChestCount",    0),
+    ("maxChestCount",    3),
+    ("minMonsterCount",  1),
+    ("maxMonsterCount",  2),
+    ("decorDensity",     0.5),
+    ("solidTile",        '#'),
+    ("roomTile",         ' '),
+    ("tunnelTile",       ' '),
+    ("doorTile",         'O'),
+    ("bossWallTile",     '?'),
+    ("bossTile",         '@'),
+    ("chestTile",        '$'),
+    ("monsterTile",      '~'),
+    ("stairTile",        '/'),
+    ("upStairTile",      '\\'),
+    ("featureRooms",     True),
+    ("featurePaths",     True),
+    ("featureRoomDecor", True),
+    ("placement",        "reject"),
+    ("pathCandidates",   "all"),
+    ("pathNeighbours",   8),
+    ("worldBackend",     "list"),
+    ("roomTable",        ()),
+)
+
+# Room classes from other modules are named with their module, so two classes
+# with the same name can't share a digest. This module's own classes leave it
+# out, so digests match whether it's imported or run as a script. Prefab rooms
+# draw whatever their art says, so that identifies them as well.
+def _roomTypeKey(newRoom):
+    name = newRoom.__qualname__
+    if newRoom.__module__ != __name__:
+        name = f"{newRoom.__module__}.{name}"
+    if issubclass(newRoom, PrefabRoom):
+        return (name, newRoom.PREFAB)
+    return name
+
+# Everything that affects what gets generated. Instances are immutable, so one
+# config can be shared between threads; use _replace() to derive variations.
+class DungeonConfig(namedtuple("DungeonConfig", [name for name, default in _CONFIG_FIELDS],
+                               defaults = [default for name, default in _CONFIG_FIELDS])):
+    __slots__ = ()
+    
+    # Snapshot of the module-level configuration constants, with ROOM_TABLE
+    # sorted so higher priority rooms are placed first
+    @classmethod
+    def fromGlobals(cls):
+        return cls(worldWidth = WORLD_WIDTH, worldHeight = WORLD_HEIGHT, roomCount = ROOM_COUNT,
+                   minRoomWidth = MIN_ROOM_WIDTH, minRoomHeight = MIN_ROOM_HEIGHT,
+                   maxRoomWidth = MAX_ROOM_WIDTH, maxRoomHeight = MAX_ROOM_HEIGHT,
+                   minBossRadius = MIN_BOSS_RADIUS, maxBossRadius = MAX_BOSS_RADIUS,
+                   minChestCount = MIN_CHEST_COUNT, maxChestCount = MAX_CHEST_COUNT,
+                   minMonsterCount = MIN_MONSTER_COUNT, maxMonsterCount = MAX_MONSTER_COUNT,
+                   decorDensity = DECOR_DENSITY,
+                   solidTile = solidTile, roomTile = roomTile, tunnelTile = tunnelTile,
+                   doorTile = doorTile, bossWallTile = bossWallTile, bossTile = bossTile,
+                   chestTile = chestTile, monsterTile = monsterTile, stairTile = stairTile,
+                   upStairTile = upStairTile,
+                   featureRooms = FEATURE_ROOMS, featurePaths = FEATURE_PATHS,
+                   featureRoomDecor = FEATURE_ROOM_DECOR,
+                   placement = PLACEMENT_STRATEGY, pathCandidates = PATH_CANDIDATES, pathNeighbours = PATH_NEIGHBOURS,
+                   worldBackend = WORLD_BACKEND, roomTable = tuple(sorted(ROOM_TABLE, reverse = True, key = lambda data : data.priority)))
+    
+    def validate(self):
+        if self.roomCount <= 1:
+            raise ValueError("roomCount must be at least 2")
+        if self.minRoomWidth <= 1 or self.minRoomHeight <= 1:
+            raise ValueError("Minimum room size must be at least 2x2")
+        if self.maxRoomWidth <= self.minRoomWidth or self.maxRoomHeight <= self.minRoomHeight:
+            raise ValueError("Maximum room size must be larger than the minimum")
+        if self.worldWidth < self.minRoomWidth or self.worldHeight < self.minRoomHeight:
+            raise ValueError("World is smaller than the minimum room size")
+        if not self.roomTable:
+            raise ValueError("roomTable is empty")
+        if self.maxChestCount <= self.minChestCount or self.maxMonsterCount <= self.minMonsterCount:
+            raise ValueError("Maximum chest and monster counts must be larger than the minimum")
+        if not 0 <= self.decorDensity <= 1:
+            raise ValueError("decorDensity must be between 0 and 1")
+        # Room.placeDecor() caps decor at this many tiles, keeping one for the stairs
+        budget = int((self.minRoomWidth * self.minRoomHeight - 1) * self.decorDensity)
+        if self.minMonsterCount + self.minChestCount > budget:
+            raise ValueError(f"Minimum chest and monster counts don't fit in the smallest room, "
+                             f"which has room for {budget} at this decorDensity")
+        if self.placement not in ("reject", "packed"):
+            raise ValueError(f"Unknown placement strategy: {self.placement}")
+        # Builds each prefab's template, which checks its art
+        for data in self.roomTable:
+            if issubclass(data.newRoom, PrefabRoom):
+                template = prefabShape(self, data.newRoom.PREFAB)
+                if template.width > self.worldWidth or template.height > self.worldHeight:
+                    raise ValueError(f"{data.newRoom.__name__} is {template.width}x{template.height}, "
+                                     f"which doesn't fit in the world")
+    
+    # Stable 8 byte fingerprint of everything that changes the generated map.
+    # The world backend is left out, since every backend produces the same tiles.
+    def digest(self):
+        fields = self._asdict()
+        del fields["worldBackend"]
+        fields["roomTable"] = [(_roomTypeKey(data.newRoom), data.weight, data.perWorldMin, data.priority) for data in self.roomTable]
+        return hashlib.blake2b(repr(sorted(fields.items())).encode(), digest_size = 8).digest()
+
+# The result of one generation run
+class Dungeon:
+    def __init__(self, config, seed):
+        self.config = config
+        self.seed = seed
+        self.world = None
+        self.rooms = []
+        self.roomCount = 0
+        # Minimum weight spanning tree, as ((roomIndex, doorBounds), (roomIndex, doorBounds), distance)
+        self.paths = []
+        self.doorCounts = []
+        self.stairs = None# (y, x)
+        self.stairRoom = None
+        self.upStairs = None# (y, x), only on floors below the top of a tower
+        self.upStairRoom = None
+        # Rooms built around fixed stairs come first, and there are this many
+        self.fixedRooms = 0
+        # Set when a room couldn't be placed and roomCount was cut short
+        self.placementFailed = False
+        # Nanoseconds spent in each phase, measured with perf_counter_ns
+        self.timings = {}
+        # Segments carved for each path, see planCorridor
+        self.corridors = []
+        # Spatial indexes used for editing, see rerollRoom and rerollPath
+        self.roomGrid = None
+        self.corridorGrid = None
+    
+    def rows(self):
+        if self.world is not None:
+            return worldRows(self.world)
+        return (self.region(0, y, self.config.worldWidth, y + 1)[0] for y in range(self.config.worldHeight))
+    
+    # Builds the grid of a dungeon generated with the "geometry" backend and
+    # keeps it, so later reads and rerolls use it. Returns the grid.
+    def materialize(self):
+        if self.world is None:
+            config = self.config
+            self.world = newWorld(config.worldWidth, config.worldHeight, config.solidTile)
+            redrawRegion(self, [0, 0, config.worldWidth, config.worldHeight])
+        return self.world
+    
+    def tileAt(self, x, y):
+        return self.region(x, y, x + 1, y + 1)[0]
+    
+    # Returns rows of tiles covering [left, right) x [top, bottom), with anything
+    # outside the world as solid rock. Without a grid, the room and corridor
+    # indexes narrow things down to what overlaps the region, and only those
+    # are drawn, in the same order generate() draws them.
+    def region(self, left, top, right, bottom):
+        config = self.config
+        solid = config.solidTile
+        area = clipBounds([left, top, right, bottom], [0, 0, config.worldWidth, config.worldHeight])
+        if area is None:
+            return [solid * (right - left)] * (bottom - top)
+        
+        if self.world is not None:
+            inner = self._gridRegion(area)
+        else:
+            inner = self._geometryRegion(area)
+        
+        before = solid * (area[LEFT] - left)
+        after = solid * (right - area[RIGHT])
+        empty = solid * (right - left)
+        return [empty] * (area[TOP] - top) + [before + row + after for row in inner] + [empty] * (bottom - area[BOTTOM])
+    
+    def _gridRegion(self, area):
+        world = self.world
+        if isinstance(world, ArrayWorld):
+            return [''.join(world.palette[code] for code in world.tiles[y, area[LEFT]:area[RIGHT]])
+                    for y in range(area[TOP], area[BOTTOM])]
+        return [''.join(world[y][area[LEFT]:area[RIGHT]]) for y in range(area[TOP], area[BOTTOM])]
+    
+    def _geometryRegion(self, area):
+        config = self.config
+        left = area[LEFT]
+        query = (area[LEFT], area[TOP], area[RIGHT] - 1, area[BOTTOM] - 1)
+        
+        rooms = [self.rooms[ri] for ri in sorted(ri for ri, bounds in self.roomGrid.query(query))]
+        segments = []
+        if config.featurePaths:
+            keys = sorted(key for key, bounds in _corridorGrid(self).query(query))
+            segments = [self.corridors[pi][si] for pi, si in keys]
+        stairs = [(position, tile) for position, tile in ((self.upStairs, config.upStairTile), (self.stairs, config.stairTile))
+                  if position is not None]
+        
+        rows = []
+        for y in range(area[TOP], area[BOTTOM]):
+            line = [area[LEFT], y, area[RIGHT], y + 1]
+            row = [config.solidTile] * (area[RIGHT] - area[LEFT])
+            
+            for room in rooms:
+                span = clipBounds(room.bounds, line)
+                if span is not None:
+                    for x in range(span[LEFT], span[RIGHT]):
+                        tile = room.drawnTile(y, x)
+                        if tile is not None:
+                            row[x - left] = tile
+            
+            for segment in segments:
+                span = clipBounds(segmentBounds(segment), line)
+                if span is not None:
+                    for x in range(span[LEFT], span[RIGHT]):
+                        row[x - left] = segmentTile(config, segment, y, x)
+            
+            for position, tile in stairs:
+                if insideBounds(position, line):
+                    row[position[1] - left] = tile
+            
+            rows.append(''.join(row))
+        return rows
+
+# Draws the stairs onto the world, only inside clip if it's given
+def placeStairs(dungeon, clip = None):
+    config = dungeon.config
+    for position, tile in ((dungeon.upStairs, config.upStairTile), (dungeon.stairs, config.stairTile)):
+        if position is not None and (clip is None or insideBounds(position, clip)):
+            setTile(dungeon.world, position[0], position[1], tile)
+
+# downStairs and upStairs fix the stairs to (y, x) positions instead of picking
+# them at random, for lining floors up. See generateTower().
+def generate(config, seed, trace = None, downStairs = None, upStairs = None):
+    config.validate()
+    
+    fixedStairs = [position for position in (downStairs, upStairs) if position is not None]
+    for position in fixedStairs:
+        if not insideBounds(position, stairArea(config)):
+            raise ValueError(f"Stairs at {position} are too close to the edge of the world")
+    if len(fixedStairs) == 2 and not stairsApart(config, downStairs, upStairs):
+        raise ValueError("Up and down stairs are too close together")
+    if len(fixedStairs) >= config.roomCount:
+        raise ValueError("roomCount is too small for fixed stairs")
+    
+    # Event checks are hoisted so that a run without tracing only pays for
+    # a few "is not None" tests per room and corridor.
+    events = trace is not None and trace.recordEvents
+    
+    dungeon = Dungeon(config, seed)
+    dungeon.trace = trace
+    world = None
+    if config.worldBackend != "geometry":
+        world = newWorld(config.worldWidth, config.worldHeight, config.solidTile, config.worldBackend)
+    dungeon.world = world
     
     # Step 1: Room generation
     
-    t0 = time.time_ns()
+    t0 = time.perf_counter_ns()
     
-    rooms = [None] * ROOM_COUNT
-    generators = [None] * ROOM_COUNT
-    roomCount = ROOM_COUNT
-    maxDoors = [0] * ROOM_COUNT
+    rooms = [None] * config.roomCount
+    roomCount = config.roomCount
     mandatoryRooms = []
     
     totalWeight = 0
     
-    for data in ROOM_TABLE:
+    for data in config.roomTable:
         totalWeight += data.weight
         for i in range(data.perWorldMin):
             mandatoryRooms.append(data)
     
-    for ri in range(ROOM_COUNT):
+    roomGrid = RoomGrid(config.maxRoomWidth, config.maxRoomHeight)
+    occupancy = OccupancyMap(config.worldWidth, config.worldHeight) if config.placement == "packed" else None
+    
+    for ri in range(config.roomCount):
         attempts = 0
         currentRoom = None
+        placed = False
         
-        if ri < len(mandatoryRooms):
-            currentRoom = mandatoryRooms[ri].newRoom()
+        mi = ri - len(fixedStairs)
         
-        rng = random.Random()
-        roomSeed = random.randrange(sys.maxsize)
-        rng.seed(roomSeed)
+        if 0 <= mi < len(mandatoryRooms):
+            currentRoom = mandatoryRooms[mi].newRoom(config)
+        
+        rng = phaseRng(seed, "room", ri)
+        
+        if ri < len(fixedStairs):
+            currentRoom = stairRoom(config, fixedStairs[ri], rng)
+            placed = True
+            if occupancy is not None:
+                occupancy.insert(currentRoom.bounds)
+        elif occupancy is not None:
+            if mi < len(mandatoryRooms):
+                currentRoom = packRoom(config, occupancy, mandatoryRooms[mi], rng)
+            else:
+                data = getWeightedRoom(config.roomTable, totalWeight, rng)
+                currentRoom = packRoom(config, occupancy, data, rng, [other for other in config.roomTable if other is not data])
+            
+            placed = currentRoom is not None
+            if placed:
+                occupancy.insert(currentRoom.bounds)
+                if events:
+                    trace.event("roomAttempt", index = ri, bounds = list(currentRoom.bounds))
         
-        while attempts < 128:
+        while not placed and occupancy is None and attempts < 128:
             # If this room isn't mandatory and we're still trying, try to generate a new room altogether.
             # This was done because sometimes it would try to generate multiple boss rooms when a second
             # is physically impossible. One particular use case ended up with there being only one room
             # because of this, which really fucks with code later on.
-            if ri >= len(mandatoryRooms) and attempts % 8 == 0:
-                currentRoom = getWeightedRoom(totalWeight).newRoom()
+            if mi >= len(mandatoryRooms) and attempts % 8 == 0:
+                currentRoom = getWeightedRoom(config.roomTable, totalWeight, rng).newRoom(config)
             
             currentRoom.generate(rng)
             
-            if ri > 0:
-                intersection = False
-                for i in range(0, ri):
-                    if intersectRect(rooms[i].bounds, currentRoom.bounds):
-                        intersection = True
-                        break
-                
-                if intersection:
-                    attempts += 1
-                    continue
-            
-            rooms[ri] = currentRoom
-            maxDoors[ri] = currentRoom.maxDoors
+            if events:
+                trace.event("roomAttempt", index = ri, bounds = list(currentRoom.bounds))
             
-            if FEATURE_ROOMS:
-                currentRoom.populate(world)
-            
-            if FEATURE_ROOM_DECOR:
-                currentRoom.populateDecor(world)
+            if roomGrid.intersects(currentRoom.bounds):
+                attempts += 1
+                continue
             
-            if PRINT_EVERY_ROOM:
-                printWorld(world, WORLD_HEIGHT, WORLD_WIDTH)
+            placed = True
             break
         
-        if attempts == 128:
-            print("Took too long to generate a room")
+        if trace is not None:
+            trace.count("placement.attempts", attempts + placed)
+            trace.count("placement.rejected", attempts)
+            trace.observe("placement.attemptsPerRoom", attempts + placed)
+        
+        if not placed:
+            if trace is not None:
+                trace.count("placement.failed")
+            dungeon.placementFailed = True
             roomCount = ri
             break
+        
+        rooms[ri] = currentRoom
+        roomGrid.insert(ri, currentRoom.bounds)
+        
+        if config.featureRooms and world is not None:
+            currentRoom.populate(world)
+        
+        if config.featureRoomDecor and world is not None:
+            currentRoom.populateDecor(world)
+        
+        if events:
+            trace.event("room", index = ri, type = type(currentRoom).__name__, bounds = currentRoom.bounds, attempts = attempts + 1)
+        
+        if PRINT_EVERY_ROOM and world is not None:
+            printWorld(world, config.worldHeight, config.worldWidth)
     
-    if DEBUG_ROOMS:
-        print("Rooms:")
-        for ri in range(roomCount):
-            print(f"#{ri}: " + str(rooms[ri].bounds))
-        print("Maximum doors:")
-        print(maxDoors)
-    
-    # Step 2: Kruskal's Algorithm
+    rooms = rooms[:roomCount]
+    dungeon.rooms = rooms
+    dungeon.roomCount = roomCount
+    
+    if trace is not None:
+        trace.count("placement.rooms", roomCount)
+        if events:
+            trace.event("rooms", bounds = [room.bounds for room in rooms], maxDoors = [room.maxDoors for room in rooms])
     
-    allDoorBounds = []# (roomIndex, doorBounds)
-    allPaths = []
+    t1 = time.perf_counter_ns()
+    dungeon.timings["rooms"] = t1 - t0
+    
+    # Step 2: Kruskal's Algorithm
     
-    for ri in range(roomCount):
-        room = rooms[ri]
+    # Doors are numbered across every room, with doorStarts[ri] as room ri's
+    # first, so edges can refer to a door by one index
+    doorRooms = []
+    doorStarts = []
+    centers = []
+    for ri, room in enumerate(rooms):
+        doorStarts.append(len(doorRooms))
         for bound in room.doorBounds:
-            allDoorBounds.append((ri, bound))
+            doorRooms.append(ri)
+            centers.append(center(bound))
+    maxDoors = [room.maxDoors for room in rooms]
     
-    for bi in range(len(allDoorBounds)):
-        for bi0 in range(bi + 1, len(allDoorBounds)):
-            doorBound = allDoorBounds[bi]
-            doorBoundOther = allDoorBounds[bi0]
-            if doorBound[0] == doorBoundOther[0]:
-                continue
-            p = (doorBound, doorBoundOther, distEuclid(center(doorBound[1]), center(doorBoundOther[1])))
-            allPaths.append(p)
+    edges = candidateEdges(config, doorRooms, centers, maxDoors)
     
-    allPaths.sort(key = lambda x : x[2])
+    if trace is not None:
+        trace.count("mst.doors", len(doorRooms))
+        trace.count("mst.candidateEdges", len(edges))
     
-    parents = [i for i in range(roomCount)]
-    ranks = [0] * roomCount
-    paths = []
-    doorCounts = [0] * roomCount
+    t2 = time.perf_counter_ns()
+    dungeon.timings["candidates"] = t2 - t1
     
-    for p in allPaths:
-        firstRoomIndex = p[0][0]
-        otherRoomIndex = p[1][0]
-        # Could add a condition to check for intersecting rooms, but that would have
-        # limited use, and wouldn't be very practical. Not to mention make the code
-        # run significantly slower.
-        if doorCounts[firstRoomIndex] == maxDoors[firstRoomIndex] or doorCounts[otherRoomIndex] == maxDoors[otherRoomIndex]:
-            continue
-        if find(parents, firstRoomIndex) != find(parents, otherRoomIndex):
-            paths.append(p)
-            union(parents, ranks, firstRoomIndex, otherRoomIndex)
-            
-            doorCounts[firstRoomIndex] += 1
-            doorCounts[otherRoomIndex] += 1
+    tree, doorCounts, edgesConsidered, skippedForDoors = doorLimitedTree(edges, doorRooms, maxDoors, roomCount)
     
-    start = 0
-    startOptions = []
-    for i in range(roomCount):
-        # There will always be a room with 1 door, because there can't be a cycle in the spanning tree.
-        if doorCounts[i] == 1:
-            startOptions.append(i)
+    paths = []
+    for d, bi, bi0 in tree:
+        firstRoomIndex = doorRooms[bi]
+        otherRoomIndex = doorRooms[bi0]
+        paths.append(((firstRoomIndex, rooms[firstRoomIndex].doorBounds[bi - doorStarts[firstRoomIndex]]),
+                      (otherRoomIndex, rooms[otherRoomIndex].doorBounds[bi0 - doorStarts[otherRoomIndex]]), d))
     
-    while True:
-        start = random.choice(startOptions)
-        if rooms[start].addStairs(world):
-            break
+    dungeon.paths = paths
+    dungeon.doorCounts = doorCounts
+    # Only the tree needed these, so they're freed before the corridors are dug
+    del edges, doorRooms, doorStarts, centers, maxDoors
     
-    if DEBUG_KRUSKAL:
-        print(f"Parents: {parents}")
-        print("Minimum weight spanning tree:")
-        for p in paths:
-            print(p)
-        print("Door counts:")
+    if trace is not None:
+        trace.count("mst.edgesConsidered", edgesConsidered)
+        trace.count("mst.skippedMaxDoors", skippedForDoors)
+        trace.count("mst.paths", len(paths))
+        # Anything short of roomCount - 1 paths leaves part of the map disconnected
+        trace.count("mst.missingPaths", roomCount - 1 - len(paths))
         for dc in doorCounts:
-            print(dc)
-        print(f"Root: #{root}, {rooms[root].bounds}")
+            trace.observe("mst.doorsPerRoom", dc)
+    
+    t3 = time.perf_counter_ns()
+    dungeon.timings["mst"] = t3 - t2
+    
+    dungeon.fixedRooms = len(fixedStairs)
+    if upStairs is not None:
+        dungeon.upStairs = upStairs
+        dungeon.upStairRoom = fixedStairs.index(upStairs)
+    
+    stairAttempts = 0
+    start = None
+    if downStairs is not None:
+        stairAttempts = 1
+        start = 0
+        dungeon.stairs = downStairs
+    else:
+        for option in stairCandidates(dungeon, phaseRng(seed, "stairs")):
+            stairAttempts += 1
+            dungeon.stairs = rooms[option].stairPosition()
+            if dungeon.stairs is not None:
+                start = option
+                break
+    
+    dungeon.stairRoom = start
+    
+    if trace is not None:
+        trace.count("stairs.attempts", stairAttempts)
+        if events:
+            trace.event("mst", paths = paths, doorCounts = doorCounts)
+            trace.event("stairs", room = start, position = dungeon.stairs, attempts = stairAttempts)
+    
+    t4 = time.perf_counter_ns()
+    dungeon.timings["stairs"] = t4 - t3
     
     # Step 3: Build Paths
     
-    if DEBUG_V_PATHS or DEBUG_H_PATHS or DEBUG_D_PATHS:
-        print("Paths:")
+    dungeon.roomGrid = roomGrid
+    corridors = []
     
-    for p in paths:
-        startRoom = p[0]
-        endRoom = p[1]
+    for pi, p in enumerate(paths):
+        segments = planCorridor(config, roomGrid, p, phaseRng(seed, "path", pi), trace)
+        corridors.append(segments)
         
-        startRoomIndex = startRoom[0]
-        endRoomIndex = endRoom[0]
+        if config.featurePaths and world is not None:
+            carveCorridor(world, config, segments)
         
-        startBounds = startRoom[1]
-        endBounds = endRoom[1]
+        if PRINT_EVERY_PATH and world is not None:
+            printWorld(world, config.worldHeight, config.worldWidth)
+    
+    dungeon.corridors = corridors
+    
+    # Straight corridors don't avoid rooms and can run right over the stairs,
+    # so the stairs go on top once everything is dug
+    if world is not None:
+        placeStairs(dungeon)
+    
+    t5 = time.perf_counter_ns()
+    dungeon.timings["corridors"] = t5 - t4
+    dungeon.timings["total"] = t5 - t0
+    
+    return dungeon
+
+# Validation
+
+class ConnectivityReport:
+    def __init__(self):
+        self.reachableTiles = 0
+        self.walkableTiles = 0
+        self.unreachableRooms = []# room indices
+        self.unreachableDecor = []# (y, x, tile)
+    
+    @property
+    def connected(self):
+        return not self.unreachableRooms and not self.unreachableDecor
+
+# Flood fills walkable tiles from the stairs and reports every room and piece of
+# decor that wasn't reached. The fill works on whole horizontal spans, and the
+# spans are found with bytearray searches, so there's no per-tile Python code.
+def validateConnectivity(dungeon):
+    config = dungeon.config
+    width = config.worldWidth
+    height = config.worldHeight
+    report = ConnectivityReport()
+    
+    blocked = (config.solidTile + config.bossWallTile).encode('latin-1')
+    toWalkable = bytes.maketrans(bytes(range(256)), b'\x01' * 256)
+    toWalkable = toWalkable[:blocked[0]] + b'\x00' + toWalkable[blocked[0] + 1:]
+    toWalkable = toWalkable[:blocked[1]] + b'\x00' + toWalkable[blocked[1] + 1:]
+    
+    walkable = bytes(b''.join(row.encode('latin-1') for row in dungeon.rows()).translate(toWalkable))
+    # 1 where a tile is walkable and hasn't been reached yet
+    unvisited = bytearray(walkable)
+    report.walkableTiles = walkable.count(1)
+    
+    if dungeon.stairs is not None:
+        y, x = dungeon.stairs
+        stack = [y * width + x]
+        while stack:
+            i = stack.pop()
+            if not unvisited[i]:
+                continue
+            rowStart = i - i % width
+            rowEnd = rowStart + width
+            left = unvisited.rfind(0, rowStart, i)
+            left = rowStart if left == -1 else left + 1
+            right = unvisited.find(0, i, rowEnd)
+            if right == -1:
+                right = rowEnd
+            unvisited[left:right] = bytes(right - left)
+            report.reachableTiles += right - left
+            
+            # Queue one seed per unvisited span in the rows above and below
+            for offset in (-width, width):
+                start = left + offset
+                end = right + offset
+                if start < 0 or end > width * height:
+                    continue
+                pos = unvisited.find(1, start, end)
+                while pos != -1:
+                    stack.append(pos)
+                    pos = unvisited.find(0, pos, end)
+                    if pos == -1:
+                        break
+                    pos = unvisited.find(1, pos, end)
+    
+    def reached(y, x):
+        i = y * width + x
+        return walkable[i] and not unvisited[i]
+    
+    for ri, room in enumerate(dungeon.rooms):
+        bounds = room.bounds
+        found = False
+        for y in range(bounds[TOP], bounds[BOTTOM]):
+            start = y * width + bounds[LEFT]
+            end = y * width + bounds[RIGHT]
+            # A tile was reached if it's walkable but no longer unvisited
+            if walkable[start:end] != bytes(unvisited[start:end]):
+                found = True
+                break
+        if not found:
+            report.unreachableRooms.append(ri)
         
-        horTunYStart = max(startBounds[TOP], endBounds[TOP])
-        horTunYEnd = min(startBounds[BOTTOM], endBounds[BOTTOM])
+        if isinstance(room, BossRoom):
+            decor = {room.center: config.bossTile}
+        else:
+            decor = room.decor
+        for (y, x), tile in decor.items():
+            if not reached(y, x):
+                report.unreachableDecor.append((y, x, tile))
+    
+    return report
+
+# Renderers
+#
+# Each renderer turns a dungeon into the bytes of one output format. Register new
+# ones with @renderer("name") and they can be picked with FILE_FORMAT, batch mode
+# or render() without touching anything else.
+
+RENDERERS = {}
+
+def renderer(name):
+    def register(function):
+        RENDERERS[name] = function
+        return function
+    return register
+
+def render(dungeon, name):
+    function = RENDERERS.get(name)
+    if function is None:
+        raise ValueError(f"Unknown output format: {name}")
+    return function(dungeon)
+
+# Just the tiles, one row per line
+@renderer("ascii")
+def renderAscii(dungeon):
+    return renderRows(list(dungeon.rows()), dungeon.config.worldWidth)
+
+# What gets printed to the console
+@renderer("axes")
+def renderConsole(dungeon):
+    return renderAxes(dungeon.rows(), dungeon.config.worldHeight, dungeon.config.worldWidth)
+
+# A short summary followed by the doubled up tiles
+@renderer("text")
+def renderText(dungeon):
+    config = dungeon.config
+    header = (f"Seed: {dungeon.seed}\n"
+              f"World size: {config.worldHeight}x{config.worldWidth} (Height x Width)\n"
+              f"Room count: {dungeon.roomCount}\n"
+              f"Room size: {config.minRoomWidth}x{config.minRoomHeight} - {config.maxRoomWidth}x{config.maxRoomHeight}\n").encode()
+    return renderRows(list(dungeon.rows()), config.worldWidth, doubled = True, header = header)
+
+# Grayscale shade for each kind of tile in PNG output
+def tileShades(config):
+    return {config.solidTile: 0, config.bossWallTile: 64, config.stairTile: 32,
+            config.upStairTile: 32, config.bossTile: 96, config.monsterTile: 128,
+            config.doorTile: 160, config.chestTile: 200, config.roomTile: 255, config.tunnelTile: 255}
+
+# One pixel per tile, 8-bit grayscale
+@renderer("png")
+def renderPng(dungeon):
+    import zlib
+    config = dungeon.config
+    width = config.worldWidth
+    height = config.worldHeight
+    
+    shades = bytearray(range(256))
+    for tile, shade in tileShades(config).items():
+        shades[ord(tile)] = shade
+    
+    # Each scanline starts with filter type 0, which is the NUL already in the buffer
+    pixels = bytearray(height * (width + 1))
+    for y, row in enumerate(dungeon.rows()):
+        start = y * (width + 1) + 1
+        pixels[start:start + width] = row.encode('latin-1').translate(shades)
+    
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    
+    return b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(bytes(pixels), 6)),
+                     chunk(b'IEND', b'')])
+
+@renderer("binary")
+def renderBinary(dungeon):
+    return dungeonBytes(dungeon)
+
+# Binary output
+#
+# Layout, all little-endian:
+#   header      BINARY_HEADER, see below
+#   palette     one byte per tile character, indexed by tile code
+#   rooms       per room: type name length (B), type name, max doors (B),
+#               bounds (4i), door count (B), door bounds (4i each)
+#   paths       per path: BINARY_PATH
+#   row index   RLE only: height + 1 offsets (Q) into the file, one per row
+#   rows        one tile code per tile, or per row (count, code) byte pairs
+
+BINARY_MAGIC = b'DUNG'
+BINARY_VERSION = 1
+BINARY_RLE = 1
+# magic, version, flags, seed, width, height, config digest, stairs y, stairs x,
+# palette size, room count, path count, rooms offset, paths offset, rows offset
+BINARY_HEADER = struct.Struct('<4sHHqII8siiHIIQQQ')
+BINARY_BOUNDS = struct.Struct('<4i')
+BINARY_PATH = struct.Struct('<II4i4id')
+# The header's seed is a signed 64 bit number
+BINARY_MIN_SEED = -2 ** 63
+BINARY_MAX_SEED = 2 ** 63 - 1
+# Room index stored for the far end of a path that leads to a bare point
+BINARY_NO_ROOM = 0xFFFFFFFF
+
+def _encodeRow(codes, rle):
+    if not rle:
+        return codes
+    out = bytearray()
+    i = 0
+    while i < len(codes):
+        code = codes[i]
+        run = 1
+        while run < 255 and i + run < len(codes) and codes[i + run] == code:
+            run += 1
+        out.append(run)
+        out.append(code)
+        i += run
+    return bytes(out)
+
+def dungeonBytes(dungeon, rle = True):
+    config = dungeon.config
+    if not BINARY_MIN_SEED <= dungeon.seed <= BINARY_MAX_SEED:
+        raise ValueError(f"Seed {dungeon.seed} can't be stored in a dungeon file, "
+                         f"it must be from {BINARY_MIN_SEED} to {BINARY_MAX_SEED}")
+    
+    # The palette is sorted so every world backend writes identical files
+    rows = [row.encode('latin-1') for row in dungeon.rows()]
+    palette = bytes(sorted(set().union(*rows)))
+    toCodes = bytes.maketrans(palette, bytes(range(len(palette))))
+    rows = [row.translate(toCodes) for row in rows]
+    
+    rooms = bytearray()
+    for room in dungeon.rooms:
+        name = type(room).__name__.encode()
+        rooms += struct.pack('<B', len(name)) + name + struct.pack('<B', room.maxDoors)
+        rooms += BINARY_BOUNDS.pack(*room.bounds)
+        rooms += struct.pack('<B', len(room.doorBounds))
+        for bound in room.doorBounds:
+            rooms += BINARY_BOUNDS.pack(*bound)
+    
+    paths = bytearray()
+    for p in dungeon.paths:
+        endRoom = BINARY_NO_ROOM if p[1][0] is None else p[1][0]
+        paths += BINARY_PATH.pack(p[0][0], endRoom, *p[0][1], *p[1][1], p[2])
+    
+    rows = [_encodeRow(row, rle) for row in rows]
+    
+    roomsOffset = BINARY_HEADER.size + len(palette)
+    pathsOffset = roomsOffset + len(rooms)
+    rowsOffset = pathsOffset + len(paths)
+    
+    index = b''
+    if rle:
+        offsets = [rowsOffset + 8 * (len(rows) + 1)]
+        for row in rows:
+            offsets.append(offsets[-1] + len(row))
+        index = struct.pack(f'<{len(offsets)}Q', *offsets)
+    
+    stairY, stairX = dungeon.stairs if dungeon.stairs is not None else (-1, -1)
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_RLE if rle else 0, dungeon.seed,
+                                config.worldWidth, config.worldHeight, config.digest(), stairY, stairX,
+                                len(palette), dungeon.roomCount, len(dungeon.paths),
+                                roomsOffset, pathsOffset, rowsOffset)
+    return b''.join([header, palette, rooms, paths, index] + rows)
+
+def writeDungeonFile(dungeon, fileName, rle = True):
+    with open(fileName, 'wb') as f:
+        f.write(dungeonBytes(dungeon, rle))
+
+# Reads a file written by writeDungeonFile without loading it. The file is
+# memory-mapped, and only the rows that are asked for get decoded.
+class DungeonFile:
+    def __init__(self, fileName):
+        import mmap
+        with open(fileName, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        
+        (magic, version, flags, self.seed, self.width, self.height, self.configDigest,
+         stairY, stairX, paletteSize, self.roomCount, self.pathCount,
+         self.roomsOffset, self.pathsOffset, self.rowsOffset) = BINARY_HEADER.unpack_from(self.data)
+        
+        if magic != BINARY_MAGIC:
+            self.close()
+            raise ValueError(f"{fileName} is not a dungeon file")
+        if version != BINARY_VERSION:
+            self.close()
+            raise ValueError(f"{fileName} has unsupported version {version}")
+        
+        self.rle = bool(flags & BINARY_RLE)
+        self.stairs = (stairY, stairX) if stairY >= 0 else None
+        self.palette = self.data[BINARY_HEADER.size:BINARY_HEADER.size + paletteSize]
+        self.fromCodes = bytes.maketrans(bytes(range(paletteSize)), self.palette)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def close(self):
+        self.data.close()
+    
+    def _rowCodes(self, y):
+        if not 0 <= y < self.height:
+            raise IndexError(f"Row {y} is outside the dungeon")
+        if not self.rle:
+            start = self.rowsOffset + y * self.width
+            return self.data[start:start + self.width]
+        start, end = struct.unpack_from('<2Q', self.data, self.rowsOffset + 8 * y)
+        encoded = self.data[start:end]
+        return b''.join(bytes((encoded[i + 1],)) * encoded[i] for i in range(0, len(encoded), 2))
+    
+    def row(self, y, left = 0, right = None):
+        return self._rowCodes(y)[left:right].translate(self.fromCodes).decode('latin-1')
+    
+    def region(self, left, top, right, bottom):
+        return [self.row(y, left, right) for y in range(top, bottom)]
+    
+    # Yields (type name, max doors, bounds, door bounds) for every room
+    def rooms(self):
+        offset = self.roomsOffset
+        for i in range(self.roomCount):
+            nameLength = self.data[offset]
+            name = self.data[offset + 1:offset + 1 + nameLength].decode()
+            offset += 1 + nameLength
+            maxDoors = self.data[offset]
+            bounds = list(BINARY_BOUNDS.unpack_from(self.data, offset + 1))
+            doorCount = self.data[offset + 1 + BINARY_BOUNDS.size]
+            offset += 2 + BINARY_BOUNDS.size
+            doorBounds = []
+            for d in range(doorCount):
+                doorBounds.append(list(BINARY_BOUNDS.unpack_from(self.data, offset)))
+                offset += BINARY_BOUNDS.size
+            yield (name, maxDoors, bounds, doorBounds)
+    
+    # Yields paths the same way Dungeon.paths stores them
+    def paths(self):
+        for i in range(self.pathCount):
+            values = BINARY_PATH.unpack_from(self.data, self.pathsOffset + i * BINARY_PATH.size)
+            endRoom = None if values[1] == BINARY_NO_ROOM else values[1]
+            yield ((values[0], list(values[2:6])), (endRoom, list(values[6:10])), values[10])
+
+# Caching
+
+# Keeps recently generated dungeons so revisited seeds don't get regenerated.
+# Entries are keyed by seed, config digest and generator version, so changing
+# anything that affects generation (room table weights, room sizes, ...) can
+# never hand back a stale map. Recently used dungeons are kept in memory, and
+# if a directory is given, everything generated is also pickled there. The
+# directory is trimmed back to maxDiskBytes, least recently used files first.
+#
+# Cached dungeons are shared, not copied: every memory hit for a seed returns
+# the same Dungeon, and store() keeps the one it's given. Treat them as read-only.
+# To edit one with rerollRoom() or rerollPath(), copy.deepcopy() it first, or
+# later lookups get the edited map and disagree with the copy on disk.
+class DungeonCache:
+    def __init__(self, maxEntries = 128, directory = None, maxDiskBytes = 256 * 1024 * 1024):
+        import threading
+        self.maxEntries = maxEntries
+        self.directory = directory
+        self.maxDiskBytes = maxDiskBytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.diskBytes = 0
+        
+        if directory is not None:
+            os.makedirs(directory, exist_ok = True)
+            for name in os.listdir(directory):
+                if name.endswith(".dungeon"):
+                    self.diskBytes += os.path.getsize(os.path.join(directory, name))
+    
+    @staticmethod
+    def key(config, seed):
+        return (seed, config.digest().hex(), GENERATOR_VERSION)
+    
+    def _fileName(self, key):
+        return os.path.join(self.directory, f"{key[0]}-{key[1]}-v{key[2]}.dungeon")
+    
+    # Returns the cached dungeon, or None if it isn't cached anywhere. The
+    # dungeon is shared with the cache, so it mustn't be edited.
+    def lookup(self, config, seed):
+        import pickle
+        key = self.key(config, seed)
+        with self.lock:
+            dungeon = self.memory.get(key)
+            if dungeon is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return dungeon
+        
+        if self.directory is None:
+            return None
+        
+        fileName = self._fileName(key)
+        try:
+            with open(fileName, 'rb') as f:
+                dungeon = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        
+        # Guards against a mangled file or a digest collision
+        if dungeon.seed != seed or dungeon.config.digest() != config.digest():
+            return None
+        
+        try:
+            os.utime(fileName)
+        except OSError:
+            pass
         
-        verTunXStart = max(startBounds[LEFT], endBounds[LEFT])
-        verTunXEnd = min(startBounds[RIGHT], endBounds[RIGHT])
+        with self.lock:
+            self.diskHits += 1
+            self._remember(key, dungeon)
+        return dungeon
+    
+    def _remember(self, key, dungeon):
+        self.memory[key] = dungeon
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxEntries:
+            self.memory.popitem(last = False)
+    
+    def store(self, dungeon):
+        import pickle
+        import threading
+        key = self.key(dungeon.config, dungeon.seed)
+        with self.lock:
+            self._remember(key, dungeon)
+        
+        if self.directory is None:
+            return
         
-        # vertical tunnel
-        startY = 0
-        endY = 0
-        tunnelX = 0
+        # Traces can hold callbacks that don't pickle, and aren't worth keeping
+        trace = dungeon.trace
+        dungeon.trace = None
+        try:
+            data = pickle.dumps(dungeon, pickle.HIGHEST_PROTOCOL)
+        finally:
+            dungeon.trace = trace
         
-        # horizontal tunnel
-        startX = 0
-        startX = 0
-        tunnelY = 0
+        fileName = self._fileName(key)
+        temporary = f"{fileName}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, fileName)
         
-        if horTunYStart < horTunYEnd:
-            if DEBUG_H_PATHS:
-                print("Horizontal needed")
-            if startBounds[LEFT] > endBounds[LEFT]:
-                startX = endBounds[RIGHT]
-                endX = startBounds[LEFT]
+        with self.lock:
+            self.diskBytes += len(data)
+            if self.diskBytes > self.maxDiskBytes:
+                self._trimDisk()
+    
+    def _trimDisk(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".dungeon"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        
+        files.sort()
+        self.diskBytes = sum(size for mtime, size, path in files)
+        for mtime, size, path in files:
+            if self.diskBytes <= self.maxDiskBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.diskBytes -= size
+    
+    # Returns the cached dungeon, generating and caching it if needed. Like
+    # lookup(), the dungeon is shared with the cache.
+    def get(self, config, seed):
+        dungeon = self.lookup(config, seed)
+        if dungeon is None:
+            with self.lock:
+                self.misses += 1
+            dungeon = generate(config, seed)
+            self.store(dungeon)
+        return dungeon
+
+# Batch generation
+
+def _generateChunk(config, seeds, outputFormat):
+    return [(seed, bytes(render(generate(config, seed), outputFormat))) for seed in seeds]
+
+def _chunks(seeds, chunkSize):
+    chunk = []
+    for seed in seeds:
+        chunk.append(seed)
+        if len(chunk) == chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# Yields every result of work(config, chunk, *args) for chunks of the seeds.
+# Seeds are sent to workers in chunks, and only a few chunks per worker are in
+# flight at once so huge seed ranges don't pile up in memory. With ordered =
+# False results come back as they finish.
+def _runChunks(work, config, seeds, args, workers, chunkSize, ordered):
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    if workers == 0:
+        for chunk in _chunks(seeds, chunkSize):
+            yield from work(config, chunk, *args)
+        return
+    
+    workers = workers or os.cpu_count() or 1
+    
+    with ProcessPoolExecutor(workers) as executor:
+        maxPending = workers * 4
+        pending = deque()
+        chunks = _chunks(seeds, chunkSize)
+        
+        for chunk in chunks:
+            pending.append(executor.submit(work, config, chunk, *args))
+            if len(pending) < maxPending:
+                continue
+            if ordered:
+                yield from pending.popleft().result()
             else:
-                startX = startBounds[RIGHT]
-                endX = endBounds[LEFT]
-            
-            tunnelY = random.randrange(horTunYStart, horTunYEnd)
-            
-            if FEATURE_PATHS:
-                fillLineH(world, tunnelTile, startX, endX, tunnelY, doorTile, doorTile)
+                done, notDone = wait(pending, return_when = FIRST_COMPLETED)
+                pending = deque(notDone)
+                for future in done:
+                    yield from future.result()
+        
+        if ordered:
+            while pending:
+                yield from pending.popleft().result()
+        else:
+            done, notDone = wait(pending)
+            for future in done:
+                yield from future.result()
+
+# Yields (seed, bytes) for every seed
+def iterBatch(config, seeds, workers = None, chunkSize = 16, ordered = True, outputFormat = "text"):
+    return _runChunks(_generateChunk, config, seeds, (outputFormat,), workers, chunkSize, ordered)
+
+# Writes every dungeon to a file named after its seed
+def fileSink(fileName):
+    def write(seed, data):
+        with open(fileName.format(seed = seed), 'wb') as f:
+            f.write(data)
+    return write
+
+# Generates every seed and hands each result to sink(seed, data).
+# Returns how many dungeons were generated.
+def generateBatch(config, seeds, sink, workers = None, chunkSize = 16, ordered = True, outputFormat = "text"):
+    count = 0
+    for seed, data in iterBatch(config, seeds, workers, chunkSize, ordered, outputFormat):
+        sink(seed, data)
+        count += 1
+    return count
+
+# Seed sweeps
+#
+# Generates a long run of seeds and keeps statistics about each map instead of
+# the map itself, for tuning ROOM_TABLE weights, boss radii and room sizes.
+# Seeds are generated on worker processes like a batch, one record per map is
+# streamed to a file, and totals are kept as running sums and histograms, so a
+# sweep uses the same memory however many maps it goes through.
+
+SWEEP_PHASES = ["rooms", "candidates", "mst", "stairs", "corridors", "total"]
+
+# Fields of a sweep record, in the order CSV files list them. roomTypes and
+# doorCounts map a room type or number of doors to how many rooms have it.
+# Times are in milliseconds.
+SWEEP_FIELDS = ["seed", "roomCount", "rooms", "placementFailed", "placementAttempts", "roomTypes",
+                "paths", "missingPaths", "doorCounts", "stairAttempts",
+                "horizontalCorridors", "verticalCorridors", "diagonalCorridors", "diagonalAttempts",
+                "diagonalGaveUp", "corridorsThroughRooms"] + [phase + "Ms" for phase in SWEEP_PHASES]
+
+# Statistics for one map. The placement and corridor counts come from the
+# dungeon's trace, so it has to be generated with one.
+def mapStats(dungeon):
+    config = dungeon.config
+    trace = dungeon.trace
+    counters = trace.counters if trace is not None else {}
+    attempts = trace.histograms.get("corridors.diagonalAttempts", {}) if trace is not None else {}
+    
+    roomTypes = {}
+    for room in dungeon.rooms:
+        name = type(room).__name__
+        roomTypes[name] = roomTypes.get(name, 0) + 1
+    doorCounts = {}
+    for count in dungeon.doorCounts:
+        doorCounts[count] = doorCounts.get(count, 0) + 1
+    
+    # Corridors that cut through or along a room other than the two they join
+    throughRooms = 0
+    for p, segments in zip(dungeon.paths, dungeon.corridors):
+        for vertical, start, end, position, firstTile, lastTile in segments:
+            intersect = intersectLineV if vertical else intersectLineH
+            if intersect(dungeon.roomGrid, start, end, position, p[0][0], p[1][0]):
+                throughRooms += 1
+                break
+    
+    record = {
+        "seed": dungeon.seed,
+        "roomCount": config.roomCount,
+        "rooms": dungeon.roomCount,
+        "placementFailed": dungeon.placementFailed,
+        "placementAttempts": counters.get("placement.attempts", 0),
+        "roomTypes": roomTypes,
+        "paths": len(dungeon.paths),
+        "missingPaths": dungeon.roomCount - 1 - sum(1 for p in dungeon.paths if p[1][0] is not None),
+        "doorCounts": doorCounts,
+        "stairAttempts": counters.get("stairs.attempts", 0),
+        "horizontalCorridors": counters.get("corridors.horizontal", 0),
+        "verticalCorridors": counters.get("corridors.vertical", 0),
+        "diagonalCorridors": counters.get("corridors.diagonal", 0),
+        "diagonalAttempts": sum(value * count for value, count in attempts.items()),
+        "diagonalGaveUp": counters.get("corridors.diagonalGaveUp", 0),
+        "corridorsThroughRooms": throughRooms,
+    }
+    for phase in SWEEP_PHASES:
+        record[phase + "Ms"] = dungeon.timings[phase] / 1000000
+    return record
+
+def _sweepChunk(config, seeds):
+    return [mapStats(generate(config, seed, Trace())) for seed in seeds]
+
+# Yields a record for every seed, in the order they finish
+def iterSweep(config, seeds, workers = None, chunkSize = 64, ordered = False):
+    return _runChunks(_sweepChunk, config, seeds, (), workers, chunkSize, ordered)
+
+# Running totals over sweep records. Numbers keep their mean, standard
+# deviation, minimum and maximum, updated with Welford's method so nothing
+# about earlier maps has to be kept. Fields holding counts, like doorCounts,
+# are added up into histograms.
+class SweepStats:
+    def __init__(self):
+        self.maps = 0
+        self.fields = {}# name -> [count, mean, sum of squared differences, min, max]
+        self.histograms = {}# name -> {value: count}
+    
+    def add(self, record):
+        self.maps += 1
+        for name, value in record.items():
+            if name == "seed":
+                continue
+            if isinstance(value, dict):
+                histogram = self.histograms.setdefault(name, {})
+                for key, count in value.items():
+                    histogram[key] = histogram.get(key, 0) + count
+                continue
             
-        elif verTunXStart < verTunXEnd:
-            if DEBUG_V_PATHS:
-                print("Vertical needed")
-            if startBounds[TOP] > endBounds[TOP]:
-                startY = endBounds[BOTTOM]
-                endY = startBounds[TOP]
+            stats = self.fields.get(name)
+            if stats is None:
+                stats = self.fields[name] = [0, 0.0, 0.0, value, value]
+            stats[0] += 1
+            delta = value - stats[1]
+            stats[1] += delta / stats[0]
+            stats[2] += delta * (value - stats[1])
+            stats[3] = min(stats[3], value)
+            stats[4] = max(stats[4], value)
+    
+    def summary(self):
+        return {
+            "maps": self.maps,
+            "fields": {name: {"mean": mean, "stdev": sqrt(squares / count), "min": low, "max": high}
+                       for name, (count, mean, squares, low, high) in self.fields.items()},
+            "histograms": {name: {str(key): histogram[key] for key in sorted(histogram)}
+                           for name, histogram in self.histograms.items()},
+        }
+    
+    def printStats(self):
+        print(f"Maps: {self.maps}")
+        for name, (count, mean, squares, low, high) in self.fields.items():
+            print(f"\t{name}: mean {mean:.3f}, stdev {sqrt(squares / count):.3f}, min {low}, max {high}")
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            print(f"\t{name}: " + ", ".join(f"{key}: {histogram[key]}" for key in sorted(histogram)))
+
+# Replaces the file in one step, so it never holds half a summary
+def writeSweepSummary(stats, fileName):
+    import json
+    with open(fileName + ".tmp", 'wt') as f:
+        json.dump(stats.summary(), f, indent = 4)
+    os.replace(fileName + ".tmp", fileName)
+
+# Generates every seed and writes its record to fileName, as JSON lines, or as
+# CSV if the name ends in .csv. Every summaryEvery maps, and at the end, the
+# totals so far are written to summaryFileName if it's given. A summaryEvery of
+# 0 only writes them at the end. Returns the totals.
+def runSweep(config, seeds, fileName, summaryFileName = None, summaryEvery = 10000, workers = None, chunkSize = 64):
+    import json
+    if summaryEvery < 0:
+        raise ValueError("summaryEvery can't be negative")
+    stats = SweepStats()
+    
+    with open(fileName, 'wt', newline = '') as f:
+        writer = None
+        if fileName.endswith(".csv"):
+            import csv
+            writer = csv.DictWriter(f, SWEEP_FIELDS)
+            writer.writeheader()
+        
+        for record in iterSweep(config, seeds, workers, chunkSize):
+            if writer is None:
+                f.write(json.dumps(record) + "\n")
             else:
-                startY = startBounds[BOTTOM]
-                endY = endBounds[TOP]
-            
-            tunnelX = random.randrange(verTunXStart, verTunXEnd)
-            
-            if FEATURE_PATHS:
-                fillLineV(world, tunnelTile, startY, endY, tunnelX, doorTile, doorTile)
+                # CSV can't nest, so histograms go in as JSON
+                writer.writerow({name: json.dumps(value) if isinstance(value, dict) else value for name, value in record.items()})
             
+            stats.add(record)
+            if summaryFileName is not None and summaryEvery and stats.maps % summaryEvery == 0:
+                writeSweepSummary(stats, summaryFileName)
+    
+    if summaryFileName is not None:
+        writeSweepSummary(stats, summaryFileName)
+    return stats
+
+# Towers
+#
+# A tower is a stack of floors, top first. The stairs on each floor lead down
+# onto the up-stairs of the next one, on the same tile. Those positions are
+# picked from the tower seed before any floor is generated, so floors don't
+# depend on each other and can all be generated at once.
+
+class Tower:
+    def __init__(self, config, seed):
+        self.config = config
+        self.seed = seed
+        self.floors = []# Dungeon per floor, top first
+
+# Where the stairs from each floor down to the next one go, as (y, x). Stairs on
+# either side of a floor are kept apart so their rooms don't overlap.
+def towerStairs(config, seed, floorCount):
+    area = stairArea(config)
+    if area[LEFT] >= area[RIGHT] or area[TOP] >= area[BOTTOM]:
+        raise ValueError("World is too small to line up stairs between floors")
+    
+    positions = []
+    for level in range(floorCount - 1):
+        rng = phaseRng(seed, "stairs", level)
+        for attempt in range(64):
+            position = (rng.randrange(area[TOP], area[BOTTOM]), rng.randrange(area[LEFT], area[RIGHT]))
+            if not positions or stairsApart(config, positions[-1], position):
+                break
         else:
-            if DEBUG_D_PATHS:
-                print(f"Diagonal needed between {startBounds} and {endBounds}")
-            startVertical = random.random() > 0.5
-            
-            vStartTile = tunnelTile
-            vEndTile = tunnelTile
-            hStartTile = tunnelTile
-            hEndTile = tunnelTile
-            
-            attempts = 0
-            
-            # TODO make algorithm smarter
-            # TODO implement an optional diagonal tunnel
-            # NOTE: If the attempt count is too low, it will still intersect some rooms even if it doesn't have to.
-            # That's because it randomly selects new positions and gives up too easily.
-            while attempts < 32:
-                addOneV = startBounds[TOP] == endBounds[BOTTOM] or startBounds[BOTTOM] == endBounds[TOP]
-                addOneH = startBounds[LEFT] == endBounds[RIGHT] or startBounds[RIGHT] == endBounds[LEFT]
-                
-                startRY = rng.randrange(startBounds[TOP] + addOneV, startBounds[BOTTOM] - addOneV)
-                startRX = rng.randrange(startBounds[LEFT] + addOneH, startBounds[RIGHT] - addOneH)
-                endRY = rng.randrange(endBounds[TOP] + addOneV, endBounds[BOTTOM] - addOneV)
-                endRX = rng.randrange(endBounds[LEFT] + addOneH, endBounds[RIGHT] - addOneH)
-                
-                if startVertical:
-                    startY = min(startBounds[BOTTOM], endRY)
-                    endY = max(startBounds[TOP], endRY)
-                    tunnelX = startRX
-                    
-                    startX = min(endBounds[RIGHT], tunnelX)
-                    endX = max(endBounds[LEFT], startRX + 1)
-                    tunnelY = endRY
-                    
-                    vStartTile = doorTile if startY == startBounds[BOTTOM] else tunnelTile
-                    vEndTile = doorTile if endY == startBounds[TOP] else tunnelTile
-                    hStartTile = doorTile if startX == endBounds[RIGHT] else tunnelTile
-                    hEndTile = doorTile if endX == endBounds[LEFT] else tunnelTile
-                else:
-                    startX = min(startBounds[RIGHT], endRX)
-                    endX = max(startBounds[LEFT], endRX)
-                    tunnelY = startRY
-                    
-                    startY = min(endBounds[BOTTOM], tunnelY)
-                    endY = max(endBounds[TOP], startRY + 1)
-                    tunnelX = endRX
-                    
-                    vStartTile = doorTile if startY == endBounds[BOTTOM] else tunnelTile
-                    vEndTile = doorTile if endY == endBounds[TOP] else tunnelTile
-                    hStartTile = doorTile if startX == startBounds[RIGHT] else tunnelTile
-                    hEndTile = doorTile if endX == startBounds[LEFT] else tunnelTile
-                
-                if intersectLineV(world, rooms, roomCount, startY, endY, tunnelX, startRoomIndex, endRoomIndex) or \
-                   intersectLineH(world, rooms, roomCount, startX, endX, tunnelY, startRoomIndex, endRoomIndex):
-                    attempts += 1
-                    startVertical = not startVertical
-                    if DEBUG_D_PATHS:
-                        print(f"Found intersection when digging diagonal path between {startBounds} and {endBounds}")
-                    continue
-                # I would go ahead and cancel the tunnel if we can't find a non-intersecting path,
-                # but that would make parts of the map unobtainable without mining tools.
-                # So we just say 'sod it' and build the tunnel anyway.
+            raise ValueError("World is too small to line up stairs between floors")
+        positions.append(position)
+    return positions
+
+def _generateFloor(config, seed, downStairs, upStairs):
+    return generate(config, seed, None, downStairs, upStairs)
+
+# Generates every floor of a tower in its own worker process, so the whole tower
+# takes about as long as its slowest floor. The bottom floor's stairs are placed
+# like a single dungeon's, on any leaf room but the one it's entered from.
+def generateTower(config, seed, floorCount, workers = None):
+    from concurrent.futures import ProcessPoolExecutor
+    config.validate()
+    stairs = towerStairs(config, seed, floorCount)
+    
+    seeds = [deriveSeed(seed, "floor", level) for level in range(floorCount)]
+    downStairs = stairs + [None]
+    upStairs = [None] + stairs
+    
+    tower = Tower(config, seed)
+    if workers == 0 or floorCount == 1:
+        tower.floors = list(map(_generateFloor, [config] * floorCount, seeds, downStairs, upStairs))
+        return tower
+    
+    workers = min(workers or os.cpu_count() or 1, floorCount)
+    with ProcessPoolExecutor(workers) as executor:
+        tower.floors = list(executor.map(_generateFloor, [config] * floorCount, seeds, downStairs, upStairs))
+    return tower
+
+# Chunked worlds
+
+# An endless world split into square chunks that are generated on demand.
+# Each chunk is an ordinary dungeon generated from a seed derived from the
+# world seed and the chunk's coordinates. Every border between two chunks has
+# one crossing point derived the same way, and both chunks dig a corridor from
+# their nearest room to it, so neighbours line up without knowing each other.
+# Only the most recently used chunks are kept around. Every chunk gets its own
+# stairs, since there's no single start room in an endless world.
+class ChunkedWorld:
+    def __init__(self, config, seed, chunkSize = 64, roomsPerChunk = 8, maxResident = 64):
+        self.config = config._replace(worldWidth = chunkSize, worldHeight = chunkSize, roomCount = roomsPerChunk)
+        self.seed = seed
+        self.chunkSize = chunkSize
+        self.maxResident = maxResident
+        self.chunks = OrderedDict()# (cx, cy) -> Dungeon
+    
+    # Where the border between (cx, cy) and (cx + 1, cy) is crossed, as a Y offset
+    def crossingX(self, cx, cy):
+        return Random(deriveSeed(self.seed, "crossX", cx, cy)).randrange(1, self.chunkSize - 1)
+    
+    # Where the border between (cx, cy) and (cx, cy + 1) is crossed, as an X offset
+    def crossingY(self, cx, cy):
+        return Random(deriveSeed(self.seed, "crossY", cx, cy)).randrange(1, self.chunkSize - 1)
+    
+    def chunk(self, cx, cy):
+        key = (cx, cy)
+        dungeon = self.chunks.get(key)
+        if dungeon is not None:
+            self.chunks.move_to_end(key)
+            return dungeon
+        
+        dungeon = self._buildChunk(cx, cy)
+        self.chunks[key] = dungeon
+        if len(self.chunks) > self.maxResident:
+            self.chunks.popitem(last = False)
+        return dungeon
+    
+    def _buildChunk(self, cx, cy):
+        dungeon = generate(self.config, deriveSeed(self.seed, "chunk", cx, cy))
+        
+        last = self.chunkSize - 1
+        exits = [(self.crossingX(cx - 1, cy), 0), (self.crossingX(cx, cy), last),
+                 (0, self.crossingY(cx, cy - 1)), (last, self.crossingY(cx, cy))]
+        
+        for i, point in enumerate(exits):
+            self._digToBorder(dungeon, point, phaseRng(dungeon.seed, "border", i))
+        
+        # Like generate(), the stairs go on top of every corridor
+        if dungeon.world is not None:
+            placeStairs(dungeon)
+        
+        return dungeon
+    
+    # Links a border point to the nearest door with a corridor planned like any
+    # other. The link is added to the dungeon's paths and corridors, with None
+    # for the room at the point's end, so redraws and rerolls keep it. Boss rooms
+    # are only used when there's nothing else to start from.
+    def _digToBorder(self, dungeon, point, rng):
+        config = dungeon.config
+        y, x = point
+        target = [x, y, x + 1, y + 1]
+        
+        rooms = [ri for ri, room in enumerate(dungeon.rooms) if not isinstance(room, BossRoom)] or range(dungeon.roomCount)
+        d, ri, door = min((distEuclid(center(bounds), center(target)), ri, door)
+                          for ri in rooms for door, bounds in enumerate(dungeon.rooms[ri].doorBounds))
+        
+        p = ((ri, dungeon.rooms[ri].doorBounds[door]), (None, target), d)
+        segments = planCorridor(config, dungeon.roomGrid, p, rng)
+        
+        pi = len(dungeon.paths)
+        dungeon.paths.append(p)
+        dungeon.corridors.append(segments)
+        if dungeon.corridorGrid is not None:
+            _indexCorridor(dungeon, pi, segments)
+        
+        # Without a grid, region() draws the link from the corridor index
+        if config.featurePaths and dungeon.world is not None:
+            carveCorridor(dungeon.world, config, segments)
+    
+    def tileAt(self, x, y):
+        cx, localX = divmod(x, self.chunkSize)
+        cy, localY = divmod(y, self.chunkSize)
+        return self.chunk(cx, cy).tileAt(localX, localY)
+    
+    # Returns rows of tiles covering [left, right) x [top, bottom) in world coordinates
+    def region(self, left, top, right, bottom):
+        rows = []
+        size = self.chunkSize
+        for y in range(top, bottom):
+            cy, localY = divmod(y, size)
+            parts = []
+            x = left
+            while x < right:
+                cx, localX = divmod(x, size)
+                end = min(right, (cx + 1) * size)
+                parts.append(self.chunk(cx, cy).region(localX, localY, localX + end - x, localY + 1)[0])
+                x = end
+            rows.append(''.join(parts))
+        return rows
+
+# Benchmarks
+
+BENCHMARK_PHASES = ["rooms", "candidates", "mst", "stairs", "corridors", "render", "total"]
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values, pct):
+    rank = max(1, ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+# Times every phase of generating seeds 0 to runs - 1, after a few warm-up runs.
+# Rendering is timed separately and is not part of the total.
+def benchmarkConfig(config, runs, warmup = 0):
+    for seed in range(warmup):
+        render(generate(config, seed), "text")
+    
+    samples = {phase: [] for phase in BENCHMARK_PHASES}
+    roomCounts = []
+    for seed in range(runs):
+        dungeon = generate(config, seed)
+        t0 = time.perf_counter_ns()
+        render(dungeon, "text")
+        t1 = time.perf_counter_ns()
+        dungeon.timings["render"] = t1 - t0
+        for phase in BENCHMARK_PHASES:
+            samples[phase].append(dungeon.timings[phase])
+        roomCounts.append(dungeon.roomCount)
+    
+    phases = {}
+    for phase, values in samples.items():
+        values.sort()
+        phases[phase] = {
+            "mean": sum(values) / len(values) / 1000000,
+            "p50": percentile(values, 50) / 1000000,
+            "p95": percentile(values, 95) / 1000000,
+            "p99": percentile(values, 99) / 1000000,
+        }
+    
+    return {
+        "worldWidth": config.worldWidth,
+        "worldHeight": config.worldHeight,
+        "roomCount": config.roomCount,
+        "meanRoomsPlaced": sum(roomCounts) / len(roomCounts),
+        "runs": runs,
+        "phases": phases,# milliseconds
+    }
+
+# Benchmarks every combination of world size and room count
+def runBenchmarks(config, sizes, roomCounts, runs, warmup = 0):
+    results = []
+    for width, height in sizes:
+        for roomCount in roomCounts:
+            sweepConfig = config._replace(worldWidth = width, worldHeight = height, roomCount = roomCount)
+            results.append(benchmarkConfig(sweepConfig, runs, warmup))
+    return {
+        "python": sys.version.split()[0],
+        "pathCandidates": config.pathCandidates,
+        "worldBackend": config.worldBackend,
+        "results": results,
+    }
+
+def printBenchmarks(report):
+    print("Size\t\tRooms\tPlaced\t" + "\t".join(BENCHMARK_PHASES) + " (p50/p95 ms)")
+    for result in report["results"]:
+        times = "\t".join(f"{result['phases'][phase]['p50']:.2f}/{result['phases'][phase]['p95']:.2f}" for phase in BENCHMARK_PHASES)
+        print(f"{result['worldWidth']}x{result['worldHeight']}\t\t{result['roomCount']}\t{result['meanRoomsPlaced']:.1f}\t{times}")
+
+# Incremental editing
+#
+# Rerolls change one room or corridor of a finished dungeon and redraw only the
+# tiles they touched. Redrawing replays, clipped to the changed area, every room,
+# decor, stairs and corridor that overlaps it in the order generate() drew them,
+# so every tile comes out exactly as a full redraw would leave it, and tiles
+# outside the changed area aren't touched at all. Rerolls edit the dungeon in
+# place, so copy dungeons from a DungeonCache before rerolling them.
+
+def _corridorGrid(dungeon):
+    if dungeon.corridorGrid is None:
+        config = dungeon.config
+        dungeon.corridorGrid = RoomGrid(config.maxRoomWidth, config.maxRoomHeight)
+        for pi, segments in enumerate(dungeon.corridors):
+            _indexCorridor(dungeon, pi, segments)
+    return dungeon.corridorGrid
+
+def _segmentEntries(segments):
+    for si, segment in enumerate(segments):
+        bounds = segmentBounds(segment)
+        if bounds is not None:
+            # The grid works with inclusive bounds
+            yield si, bounds, (bounds[LEFT], bounds[TOP], bounds[RIGHT] - 1, bounds[BOTTOM] - 1)
+
+def _indexCorridor(dungeon, pi, segments):
+    for si, bounds, inclusive in _segmentEntries(segments):
+        dungeon.corridorGrid.insert((pi, si), inclusive)
+
+# Swaps in new segments for a path and returns the areas that need redrawing
+def _replaceCorridor(dungeon, pi, segments):
+    grid = _corridorGrid(dungeon)
+    dirty = []
+    for si, bounds, inclusive in _segmentEntries(dungeon.corridors[pi]):
+        grid.remove((pi, si), inclusive)
+        dirty.append(bounds)
+    dungeon.corridors[pi] = segments
+    _indexCorridor(dungeon, pi, segments)
+    for si, bounds, inclusive in _segmentEntries(segments):
+        dirty.append(bounds)
+    return dirty
+
+def redrawRegion(dungeon, clip):
+    config = dungeon.config
+    world = dungeon.world
+    clip = clipBounds(clip, [0, 0, config.worldWidth, config.worldHeight])
+    # Without a grid there's nothing to redraw, tiles are always worked out
+    # from the rooms and corridors as they are now
+    if clip is None or world is None:
+        return
+    query = (clip[LEFT], clip[TOP], clip[RIGHT] - 1, clip[BOTTOM] - 1)
+    
+    fill(world, config.solidTile, clip)
+    
+    for ri in sorted(ri for ri, bounds in dungeon.roomGrid.query(query)):
+        room = dungeon.rooms[ri]
+        if config.featureRooms:
+            room.populate(world, clip)
+        if config.featureRoomDecor:
+            room.populateDecor(world, clip)
+    
+    if config.featurePaths:
+        for pi in sorted({key[0] for key, bounds in _corridorGrid(dungeon).query(query)}):
+            carveCorridor(world, config, dungeon.corridors[pi], clip)
+    
+    placeStairs(dungeon, clip)
+
+# Digs a new corridor for one path. Returns the areas that were redrawn.
+def rerollPath(dungeon, pathIndex, seed):
+    rng = Random(seed)
+    segments = planCorridor(dungeon.config, dungeon.roomGrid, dungeon.paths[pathIndex], rng)
+    dirty = _replaceCorridor(dungeon, pathIndex, segments)
+    for bounds in dirty:
+        redrawRegion(dungeon, bounds)
+    return dirty
+
+# Moves one room somewhere else, with new decor, and redigs the corridors to it.
+# The room keeps its neighbours in the spanning tree, so the rest of the tree
+# and every other corridor stay as they are. Returns the areas that were
+# redrawn, or None if the room couldn't be placed anywhere new. Rooms around
+# fixed stairs can't be moved, since that would break them from the floor they
+# line up with. Packed configs place it like generate() does, anywhere it fits.
+def rerollRoom(dungeon, roomIndex, seed):
+    if roomIndex < dungeon.fixedRooms:
+        raise ValueError(f"Room {roomIndex} holds fixed stairs and can't be rerolled")
+    
+    config = dungeon.config
+    roomGrid = dungeon.roomGrid
+    rng = Random(seed)
+    oldRoom = dungeon.rooms[roomIndex]
+    
+    roomGrid.remove(roomIndex, oldRoom.bounds)
+    if config.placement == "packed":
+        occupancy = OccupancyMap(config.worldWidth, config.worldHeight)
+        for ri, room in enumerate(dungeon.rooms):
+            if ri != roomIndex:
+                occupancy.insert(room.bounds)
+        data = next((data for data in config.roomTable if data.newRoom is type(oldRoom)), None)
+        newRoom = packRoom(config, occupancy, data, rng) if data is not None else None
+    else:
+        for attempt in range(128):
+            newRoom = type(oldRoom)(config)
+            newRoom.generate(rng)
+            if not roomGrid.intersects(newRoom.bounds):
                 break
-            
-            if FEATURE_PATHS:
-                fillLineV(world, tunnelTile, startY, endY, tunnelX, vStartTile, vEndTile)
-                fillLineH(world, tunnelTile, startX, endX, tunnelY, hStartTile, hEndTile)
+        else:
+            newRoom = None
+    
+    if newRoom is None:
+        roomGrid.insert(roomIndex, oldRoom.bounds)
+        return None
+    
+    roomGrid.insert(roomIndex, newRoom.bounds)
+    dungeon.rooms[roomIndex] = newRoom
+    dirty = [oldRoom.bounds, newRoom.bounds]
+    
+    for pi, p in enumerate(dungeon.paths):
+        if p[0][0] != roomIndex and p[1][0] != roomIndex:
+            continue
+        other = p[1] if p[0][0] == roomIndex else p[0]
+        otherDoors = [other[1]] if other[0] is None else dungeon.rooms[other[0]].doorBounds
+        # Connect the closest pair of doors, keeping the path's direction
+        d, door, otherDoor = min((distEuclid(center(door), center(otherDoor)), i, j)
+                                 for i, door in enumerate(newRoom.doorBounds)
+                                 for j, otherDoor in enumerate(otherDoors))
+        moved = (roomIndex, newRoom.doorBounds[door])
+        kept = (other[0], otherDoors[otherDoor])
+        p = (moved, kept, d) if p[0][0] == roomIndex else (kept, moved, d)
+        dungeon.paths[pi] = p
+        dirty += _replaceCorridor(dungeon, pi, planCorridor(config, roomGrid, p, rng))
+    
+    if dungeon.stairRoom == roomIndex:
+        y, x = dungeon.stairs
+        dirty.append([x, y, x + 1, y + 1])
+        dungeon.stairs = newRoom.stairPosition()
+        dungeon.stairRoom = roomIndex
+        # The new room can only be too small for stairs if the old one was as well
+        if dungeon.stairs is None:
+            dungeon.stairRoom = None
+            for start in stairCandidates(dungeon, rng):
+                dungeon.stairs = dungeon.rooms[start].stairPosition()
+                if dungeon.stairs is not None:
+                    dungeon.stairRoom = start
+                    break
+        if dungeon.stairs is not None:
+            y, x = dungeon.stairs
+            dirty.append([x, y, x + 1, y + 1])
+    
+    for bounds in dirty:
+        redrawRegion(dungeon, bounds)
+    return dirty
+
+# Dungeon service
+#
+# Serves dungeons to other local processes over TCP, so game servers don't have
+# to start a new Python process per map. A request is one line of JSON, like
+#   {"seed": 5, "format": "binary", "config": {"roomCount": 32}}
+# where format defaults to "binary" and config holds DungeonConfig fields to
+# change from the service's own config. The reply is a line of JSON, either
+# {"length": n} followed by n bytes of output, or {"error": "..."}. Requests on
+# one connection are answered in the order they were sent.
+
+class DungeonService:
+    def __init__(self, config, workers = None, maxEntries = 256, prewarm = (), prewarmFormat = "binary"):
+        self.config = config
+        self.workers = workers# None uses every core, 0 generates on a thread in this process
+        self.maxEntries = maxEntries
+        self.prewarm = prewarm
+        self.prewarmFormat = prewarmFormat
+        self.results = OrderedDict()# key -> rendered bytes, most recently used last
+        self.pending = {}# key -> task generating it
+        self.connections = {}# writer -> task serving it
+        self.executor = None
+        self.server = None
+        self.prewarmTask = None
+        self.generated = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.prewarmFailed = 0
+    
+    # Starts listening and prewarming. Returns the (host, port) being listened
+    # on, since port 0 picks a free one.
+    async def start(self, host = "127.0.0.1", port = 0):
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+        if self.workers != 0:
+            self.executor = ProcessPoolExecutor(self.workers or os.cpu_count() or 1)
+        self.server = await asyncio.start_server(self._serve, host, port)
+        if self.prewarm:
+            self.prewarmTask = asyncio.ensure_future(self._prewarm())
+        return self.server.sockets[0].getsockname()[:2]
+    
+    async def close(self):
+        import asyncio
+        if self.prewarmTask is not None:
+            self.prewarmTask.cancel()
+        self.server.close()
+        # Hanging up makes each connection's reader see the end of its stream
+        for writer in self.connections:
+            writer.close()
+        await asyncio.gather(*self.connections.values(), return_exceptions = True)
+        await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures = True)
+    
+    # Only keeps as many prewarm seeds in flight as there are workers, so
+    # requests that come in meanwhile don't queue up behind all of them. A seed
+    # that fails is reported and skipped, and the rest still get prewarmed.
+    async def _prewarm(self):
+        import asyncio
+        seeds = iter(self.prewarm)
         
-        if PRINT_EVERY_PATH:
-            printWorld(world, WORLD_HEIGHT, WORLD_WIDTH)
+        async def worker():
+            for seed in seeds:
+                try:
+                    await self.get(self.config, seed, self.prewarmFormat)
+                except Exception as e:
+                    self.prewarmFailed += 1
+                    print(f"Prewarming seed {seed} failed: {e}", file = sys.stderr)
+        
+        await asyncio.gather(*(worker() for i in range(self.workers or os.cpu_count() or 1)))
     
-    # Final step: Present
+    # The service's config with the given fields changed
+    def configFor(self, fields):
+        if not fields:
+            return self.config
+        if not isinstance(fields, dict):
+            raise ValueError("config must be an object")
+        for name in fields:
+            if name not in DungeonConfig._fields or name == "roomTable":
+                raise ValueError(f"Unknown config field: {name}")
+        config = self.config._replace(**fields)
+        config.validate()
+        return config
+    
+    # Returns a dungeon's output, generating it in the worker pool if needed.
+    # Requests for a dungeon that's already being generated wait for the same
+    # result instead of generating it again.
+    async def get(self, config, seed, outputFormat):
+        import asyncio
+        if outputFormat not in RENDERERS:
+            raise ValueError(f"Unknown output format: {outputFormat}")
+        key = (DungeonCache.key(config, seed), outputFormat)
+        
+        data = self.results.get(key)
+        if data is not None:
+            self.results.move_to_end(key)
+            self.hits += 1
+            return data
+        
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate(key, config, seed, outputFormat))
+            self.pending[key] = task
+        else:
+            self.coalesced += 1
+        # One client hanging up mustn't cancel a dungeon others are waiting on
+        return await asyncio.shield(task)
+    
+    async def _generate(self, key, config, seed, outputFormat):
+        import asyncio
+        try:
+            chunk = await asyncio.get_running_loop().run_in_executor(self.executor, _generateChunk, config, [seed], outputFormat)
+        finally:
+            del self.pending[key]
+        
+        data = chunk[0][1]
+        self.generated += 1
+        self.results[key] = data
+        while len(self.results) > self.maxEntries:
+            self.results.popitem(last = False)
+        return data
+    
+    async def _serve(self, reader, writer):
+        import asyncio
+        import json
+        self.connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # Anything going wrong is sent back, so one bad request
+                # doesn't cost the client its connection
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict) or "seed" not in request:
+                        raise ValueError("Request must be an object with a seed")
+                    seed = int(request["seed"])
+                    if not BINARY_MIN_SEED <= seed <= BINARY_MAX_SEED:
+                        raise ValueError(f"seed must be from {BINARY_MIN_SEED} to {BINARY_MAX_SEED}")
+                    data = await self.get(self.configFor(request.get("config")), seed, request.get("format", "binary"))
+                except Exception as e:
+                    writer.write(json.dumps({"error": str(e) or type(e).__name__}).encode() + b'\n')
+                else:
+                    writer.write(json.dumps({"length": len(data)}).encode() + b'\n')
+                    writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self.connections[writer]
+            writer.close()
+
+# Client for DungeonService. Requests can be made from several tasks at once,
+# and are sent one at a time over the same connection.
+class DungeonClient:
+    def __init__(self, reader, writer):
+        import asyncio
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+    
+    @classmethod
+    async def connect(cls, host = "127.0.0.1", port = SERVICE_PORT):
+        import asyncio
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+    
+    # Returns the dungeon's output as bytes. Raises ValueError if the service
+    # turned the request down.
+    async def request(self, seed, outputFormat = "binary", config = None):
+        import json
+        message = {"seed": seed, "format": outputFormat}
+        if config:
+            message["config"] = config
+        
+        async with self.lock:
+            self.writer.write(json.dumps(message).encode() + b'\n')
+            await self.writer.drain()
+            header = json.loads(await self.reader.readline())
+            if "error" in header:
+                raise ValueError(header["error"])
+            return await self.reader.readexactly(header["length"])
+    
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+async def serve(config, host, port, workers = None, maxEntries = 256, prewarm = ()):
+    service = DungeonService(config, workers, maxEntries, prewarm)
+    host, port = await service.start(host, port)
+    print(f"Serving dungeons on {host}:{port}")
+    try:
+        await service.server.serve_forever()
+    finally:
+        await service.close()
+
+# Command line
+#
+# Every flag sets one or more of the configuration constants at the top of this
+# file, and --config loads any of them from a TOML or JSON file first, so they
+# never need editing. Flags win over the file, and --set wins over both.
+
+# Constants a config file or --set can change
+SETTINGS = ("USE_CUSTOM_SEED", "CUSTOM_SEED",
+            "solidTile", "roomTile", "tunnelTile", "doorTile", "bossWallTile", "bossTile",
+            "chestTile", "monsterTile", "stairTile", "upStairTile",
+            "BENCHMARK", "BENCHMARK_RUNS", "BENCHMARK_WARMUP", "BENCHMARK_SIZES", "BENCHMARK_ROOMS", "BENCHMARK_FILE",
+            "PRINT_TO_FILE", "FILE_NAME", "FILE_FORMAT",
+            "BATCH_SEEDS", "BATCH_FILE_NAME", "BATCH_WORKERS", "BATCH_CHUNK_SIZE", "BATCH_ORDERED",
+            "SWEEP_SEEDS", "SWEEP_FILE", "SWEEP_SUMMARY_FILE", "SWEEP_SUMMARY_EVERY",
+            "TOWER_FLOORS", "TOWER_FILE_NAME", "TOWER_WORKERS",
+            "SERVICE", "SERVICE_HOST", "SERVICE_PORT", "SERVICE_WORKERS", "SERVICE_CACHE_SIZE", "SERVICE_PREWARM",
+            "MIN_ROOM_HEIGHT", "MIN_ROOM_WIDTH", "MAX_ROOM_HEIGHT", "MAX_ROOM_WIDTH",
+            "MIN_BOSS_RADIUS", "MAX_BOSS_RADIUS", "WORLD_HEIGHT", "WORLD_WIDTH", "ROOM_COUNT",
+            "WORLD_BACKEND", "PLACEMENT_STRATEGY", "PATH_CANDIDATES", "PATH_NEIGHBOURS",
+            "MIN_CHEST_COUNT", "MAX_CHEST_COUNT", "MIN_MONSTER_COUNT", "MAX_MONSTER_COUNT", "DECOR_DENSITY",
+            "FEATURE_ROOMS", "FEATURE_PATHS", "FEATURE_ROOM_DECOR",
+            "PRINT_FINAL_DUNGEON", "PRINT_EVERY_ROOM", "PRINT_EVERY_PATH",
+            "VALIDATE_CONNECTIVITY", "TRACE_EVENTS", "PRINT_STATS")
+
+# Flags that set a single constant to their value
+FLAG_SETTINGS = {"width": "WORLD_WIDTH", "height": "WORLD_HEIGHT", "rooms": "ROOM_COUNT",
+                 "backend": "WORLD_BACKEND", "placement": "PLACEMENT_STRATEGY",
+                 "candidates": "PATH_CANDIDATES", "format": "FILE_FORMAT", "tower": "TOWER_FLOORS",
+                 "host": "SERVICE_HOST", "port": "SERVICE_PORT"}
+
+def argumentParser():
+    import argparse
+    parser = argparse.ArgumentParser(description = "Generates dungeon maps. Anything not given here comes from "
+                                                   "--config, or the constants at the top of DungeonGenerator.py.")
+    parser.add_argument("--config", metavar = "FILE", help = "TOML or JSON file setting any of the constants by name")
+    parser.add_argument("--set", metavar = "NAME=VALUE", action = "append", default = [],
+                        help = "set one constant, with VALUE read as JSON if it's valid JSON")
+    parser.add_argument("--seed", type = int, help = "generate this seed instead of a random one")
+    parser.add_argument("--width", type = int, help = "world width in tiles")
+    parser.add_argument("--height", type = int, help = "world height in tiles")
+    parser.add_argument("--rooms", type = int, help = "number of rooms")
+    parser.add_argument("--backend", choices = ("list", "numpy", "geometry"))
+    parser.add_argument("--placement", choices = ("reject", "packed"))
+    parser.add_argument("--candidates", choices = ("all", "knn"))
+    parser.add_argument("--format", choices = sorted(RENDERERS), help = "format of written files")
+    parser.add_argument("--output", metavar = "FILE", help = "write the map to FILE, with {floor} in the name for a tower")
+    parser.add_argument("--quiet", action = "store_true", help = "don't print the map")
+    parser.add_argument("--validate", action = "store_true", help = "check every room can be reached")
+    parser.add_argument("--stats", action = "store_true", help = "print generation counters")
+    parser.add_argument("--batch", metavar = "START:STOP", help = "generate every seed in the range")
+    parser.add_argument("--sweep", metavar = "START:STOP", help = "write statistics about every seed in the range")
+    parser.add_argument("--tower", metavar = "FLOORS", type = int, help = "generate a tower with this many floors")
+    parser.add_argument("--benchmark", action = "store_true", help = "run the benchmark suite")
+    parser.add_argument("--serve", action = "store_true", help = "run the dungeon service")
+    parser.add_argument("--host", help = "address the service listens on")
+    parser.add_argument("--port", type = int, help = "port the service listens on")
+    parser.add_argument("--workers", type = int, help = "worker processes for batch, sweep, tower and service modes")
+    return parser
+
+def loadSettings(fileName):
+    with open(fileName, 'rb') as f:
+        if fileName.endswith(".toml"):
+            try:
+                import tomllib
+            except ImportError:
+                raise ValueError("TOML config files need Python 3.11 or newer") from None
+            return tomllib.load(f)
+        import json
+        return json.load(f)
+
+def seedRange(text, flag):
+    start, sep, stop = text.partition(':')
+    if not sep:
+        raise ValueError(f"{flag} takes a range of seeds like 0:1000")
+    return range(int(start), int(stop))
+
+# The constants to change for the parsed arguments
+def settingsFromArgs(args):
+    settings = loadSettings(args.config) if args.config else {}
+    
+    for flag, name in FLAG_SETTINGS.items():
+        value = getattr(args, flag)
+        if value is not None:
+            settings[name] = value
+    
+    if args.seed is not None:
+        settings["USE_CUSTOM_SEED"] = True
+        settings["CUSTOM_SEED"] = args.seed
+    if args.batch is not None:
+        settings["BATCH_SEEDS"] = seedRange(args.batch, "--batch")
+    if args.sweep is not None:
+        settings["SWEEP_SEEDS"] = seedRange(args.sweep, "--sweep")
+    if args.workers is not None:
+        settings["BATCH_WORKERS"] = settings["TOWER_WORKERS"] = settings["SERVICE_WORKERS"] = args.workers
+    if args.quiet:
+        settings["PRINT_FINAL_DUNGEON"] = False
+    if args.validate:
+        settings["VALIDATE_CONNECTIVITY"] = True
+    if args.stats:
+        settings["PRINT_STATS"] = True
+    if args.benchmark:
+        settings["BENCHMARK"] = True
+    if args.serve:
+        settings["SERVICE"] = True
+    
+    if args.set:
+        import json
+    for item in args.set:
+        name, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError(f"--set takes NAME=VALUE, not {item}")
+        try:
+            settings[name] = json.loads(value)
+        except ValueError:
+            settings[name] = value
+    
+    # Towers write a file per floor, so the name needs somewhere to put the floor
+    if args.output is not None:
+        settings["PRINT_TO_FILE"] = True
+        if settings.get("TOWER_FLOORS", TOWER_FLOORS) > 1:
+            if "{floor}" not in args.output:
+                raise ValueError("--output needs {floor} in the file name for a tower, like floor{floor}.txt")
+            settings["TOWER_FILE_NAME"] = args.output
+        else:
+            settings["FILE_NAME"] = args.output
+    
+    return settings
+
+def applySettings(settings):
+    for name in settings:
+        if name not in SETTINGS:
+            raise ValueError(f"Unknown setting: {name}")
+    globals().update(settings)
+
+# Script entry point
+
+def main(argv = None):
+    parser = argumentParser()
+    args = parser.parse_args(argv)
+    # Settings of the wrong type mostly show up as a TypeError from validate()
+    try:
+        applySettings(settingsFromArgs(args))
+        config = DungeonConfig.fromGlobals()
+        config.validate()
+        if SWEEP_SUMMARY_EVERY < 0:
+            raise ValueError("SWEEP_SUMMARY_EVERY can't be negative")
+    except (OSError, ValueError, TypeError) as e:
+        parser.error(str(e))
+    
+    if SWEEP_SEEDS is not None:
+        stats = runSweep(config, SWEEP_SEEDS, SWEEP_FILE, SWEEP_SUMMARY_FILE, SWEEP_SUMMARY_EVERY, BATCH_WORKERS, BATCH_CHUNK_SIZE)
+        stats.printStats()
+        return
     
-    t1 = time.time_ns()
-    timeElapsed = (t1 - t0) / 1000000
+    if BATCH_SEEDS is not None:
+        seeds = [CUSTOM_SEED] if USE_CUSTOM_SEED else BATCH_SEEDS
+        count = generateBatch(config, seeds, fileSink(BATCH_FILE_NAME), BATCH_WORKERS, BATCH_CHUNK_SIZE, BATCH_ORDERED, FILE_FORMAT)
+        print(f"Generated {count} dungeons")
+        return
+    
+    if SERVICE:
+        import asyncio
+        asyncio.run(serve(config, SERVICE_HOST, SERVICE_PORT, SERVICE_WORKERS, SERVICE_CACHE_SIZE, SERVICE_PREWARM))
+        return
     
     if BENCHMARK:
-        print(f"Dungeon generated in {timeElapsed} ms")
-        return timeElapsed
+        report = runBenchmarks(config, BENCHMARK_SIZES, BENCHMARK_ROOMS, BENCHMARK_RUNS, BENCHMARK_WARMUP)
+        printBenchmarks(report)
+        import json
+        with open(BENCHMARK_FILE, 'wt') as f:
+            json.dump(report, f, indent = 4)
+        return
+    
+    seed = CUSTOM_SEED if USE_CUSTOM_SEED else random.randrange(sys.maxsize)
+    
+    print(f"Map seed (ew): {seed}")
+
+    if TOWER_FLOORS > 1:
+        tower = generateTower(config, seed, TOWER_FLOORS, TOWER_WORKERS)
+        for level, dungeon in enumerate(tower.floors):
+            if PRINT_FINAL_DUNGEON:
+                print(f"Floor {level}:")
+                printDungeon(dungeon)
+            if PRINT_TO_FILE:
+                with open(TOWER_FILE_NAME.format(floor = level), 'wb') as f:
+                    f.write(render(dungeon, FILE_FORMAT))
+        return
+
+    trace = None
+    if TRACE_EVENTS or PRINT_STATS:
+        kinds = None if TRACE_EVENTS is True else (TRACE_EVENTS or ())
+        trace = Trace(sink = printEvent if TRACE_EVENTS else None, kinds = kinds)
+    
+    dungeon = generate(config, seed, trace)
+    
+    if PRINT_STATS:
+        trace.printStats()
+    
+    if VALIDATE_CONNECTIVITY:
+        report = validateConnectivity(dungeon)
+        print(f"Reachable tiles: {report.reachableTiles} of {report.walkableTiles}")
+        for ri in report.unreachableRooms:
+            print(f"Unreachable room: #{ri} {dungeon.rooms[ri].bounds}")
+        for y, x, tile in report.unreachableDecor:
+            print(f"Unreachable decor: '{tile}' at ({y}, {x})")
+    
+    if dungeon.placementFailed:
+        print("Took too long to generate a room")
+    
+    # Final step: Present
     
     if PRINT_FINAL_DUNGEON:
-        printWorld(world, WORLD_HEIGHT, WORLD_WIDTH)
+        printDungeon(dungeon)
     
     if PRINT_TO_FILE:
-        with open(FILE_NAME, 'wt') as f:
-            f.write(f"Seed: {seed}\n")
-            f.write(f"World size: {WORLD_HEIGHT}x{WORLD_WIDTH} (Height x Width)\n")
-            f.write(f"Room count: {roomCount}\n")
-            f.write(f"Room size: {MIN_ROOM_WIDTH}x{MIN_ROOM_HEIGHT} - {MAX_ROOM_WIDTH}x{MAX_ROOM_HEIGHT}\n")
-            for y in range(0, WORLD_HEIGHT):
-                f.write(''.join([val for pair in zip(world[y], world[y]) for val in pair]) + '\n')
-
-if BENCHMARK:
-    totalTime = 0.0
-    for i in range(BENCHMARK_RUNS):
-        timeTaken = main()
-        totalTime += timeTaken
-    
-    avgTime = (totalTime / BENCHMARK_RUNS)
-    print(f"Average time: {avgTime} ms")
-else:
+        with open(FILE_NAME, 'wb') as f:
+            f.write(render(dungeon, FILE_FORMAT))
+
+if __name__ == "__main__":
     main()
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest import mock
+
+import DungeonGenerator as DG
+
+# Talks to a DungeonService over loopback. workers = 0 generates on a thread,
+# so the tests don't start a process pool.
+class DungeonServiceTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await self.startService()
+
+    async def startService(self, **options):
+        self.service = DG.DungeonService(DG.DungeonConfig.fromGlobals(), workers = 0, **options)
+        self.address = await self.service.start()
+        self.reader, self.writer = await asyncio.open_connection(*self.address)
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        await self.service.close()
+
+    async def waitFor(self, condition):
+        for i in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("timed out")
+
+    async def send(self, line):
+        self.writer.write(line + b'\n')
+        await self.writer.drain()
+        header = json.loads(await self.reader.readline())
+        if "error" in header:
+            return header
+        return await self.reader.readexactly(header["length"])
+
+    async def request(self, message):
+        return await self.send(json.dumps(message).encode())
+
+    async def testRequest(self):
+        data = await self.request({"seed": 1, "format": "text"})
+        dungeon = DG.generate(DG.DungeonConfig.fromGlobals(), 1)
+        self.assertEqual(data, DG.render(dungeon, "text"))
+
+    async def testBadRequests(self):
+        for line in (b'not json', b'[1]', b'{"format": "text"}', b'{"seed": "x"}',
+                     b'{"seed": 1, "format": "nope"}', b'{"seed": 1, "config": {"nope": 1}}',
+                     json.dumps({"seed": 2 ** 63}).encode(), json.dumps({"seed": -2 ** 63 - 1}).encode()):
+            self.assertIn("error", await self.send(line), line)
+        # The connection is still usable afterwards
+        self.assertIsInstance(await self.request({"seed": 1}), bytes)
+
+    async def testGenerationFailure(self):
+        with mock.patch.object(DG, "_generateChunk", side_effect = RuntimeError("boom")):
+            self.assertEqual(await self.request({"seed": 2}), {"error": "boom"})
+        self.assertEqual(self.service.pending, {})
+        self.assertIsInstance(await self.request({"seed": 2}), bytes)
+
+    async def testCoalescing(self):
+        clients = [await DG.DungeonClient.connect(*self.address) for i in range(3)]
+        # Generation waits until every request is waiting on it
+        release = threading.Event()
+        generateChunk = DG._generateChunk
+        def slowGenerate(*args):
+            release.wait(5)
+            return generateChunk(*args)
+
+        with mock.patch.object(DG, "_generateChunk", side_effect = slowGenerate):
+            requests = asyncio.gather(*(client.request(4) for client in clients))
+            await self.waitFor(lambda : self.service.coalesced == 2)
+            release.set()
+            results = await requests
+        for client in clients:
+            await client.close()
+
+        self.assertEqual(self.service.generated, 1)
+        self.assertEqual(results, [results[0]] * 3)
+
+    async def testPrewarm(self):
+        await self.asyncTearDown()
+        await self.startService(prewarm = [1, 2 ** 70, 3])
+        await self.waitFor(self.service.prewarmTask.done)
+        # The seed that can't be written doesn't stop the ones after it
+        self.assertIsNone(self.service.prewarmTask.exception())
+        self.assertEqual(self.service.prewarmFailed, 1)
+        self.assertEqual(self.service.generated, 2)
+
+        self.assertIsInstance(await self.request({"seed": 3}), bytes)
+        self.assertEqual(self.service.hits, 1)
+        self.assertEqual(self.service.generated, 2)
+
+if __name__ == "__main__":
+    unittest.main()